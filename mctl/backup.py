@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import logging
+import os
+import stat
+import struct
+import time
+from typing import Any, BinaryIO, Callable, Deque, Dict, List, NamedTuple, Tuple
+import zlib
+
+from mctl.config import Config, Server
+from mctl.exception import massert, MctlError
+from mctl.server import server_saves_paused
+
+BACKUP_MAGIC = b"MCTLBAK1"
+# Uncompressed size of each block handed to a compression worker. Small
+# files are packed together and large files are split to fill blocks.
+BLOCK_SIZE = 4 * 1024 * 1024
+COMPRESSIONS = ["gzip", "zstd"]
+DEFAULT_BACKUP_JOBS = os.cpu_count() or 1
+DEFAULT_COMPRESSION = "gzip"
+LOG = logging.getLogger(__name__)
+# Index offset followed by the magic, at the very end of the archive
+TRAILER = struct.Struct(f"<Q{len(BACKUP_MAGIC)}s")
+
+# (file index, offset in the file, length)
+Piece = Tuple[int, int, int]
+
+
+class BackupStats(NamedTuple):
+    files: int
+    raw_bytes: int
+    compressed_bytes: int
+    seconds: float
+
+
+def get_backups_dir(config: Config, server: Server) -> str:
+    return os.path.join(config.data_path, "backups", server.name)
+
+
+def get_codec(compression: str, level: int) -> Tuple[Callable, Callable]:
+    if compression == "gzip":
+        return (
+            lambda data: zlib.compress(data, level if level > 0 else 6),
+            zlib.decompress,
+        )
+
+    massert(compression == "zstd", f"Unknown compression: {compression}")
+    try:
+        import zstandard  # type: ignore
+    except ImportError:
+        raise MctlError("The zstandard module is required for zstd compression")
+
+    # The (de)compressor objects are not thread safe, create one per block
+    return (
+        lambda data: zstandard.ZstdCompressor(level if level > 0 else 3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def log_throughput(action: str, path: str, stats: BackupStats) -> None:
+    seconds = max(stats.seconds, 1e-6)
+    LOG.info(
+        "%s %s in %.3fs: %d files, %d bytes (%.1f MiB/s), %d bytes compressed "
+        "(%.1f%%)",
+        action,
+        path,
+        stats.seconds,
+        stats.files,
+        stats.raw_bytes,
+        stats.raw_bytes / seconds / (1024 * 1024),
+        stats.compressed_bytes,
+        100 * stats.compressed_bytes / max(stats.raw_bytes, 1),
+    )
+
+
+def scan_files(src_dir: str, skip_dir: str) -> List[Dict[str, Any]]:
+    entries: List[Dict[str, Any]] = []
+    for root, dir_names, file_names in os.walk(src_dir):
+        for name in list(dir_names):
+            path = os.path.join(root, name)
+            if os.path.realpath(path) == skip_dir:
+                dir_names.remove(name)
+            elif os.path.islink(path):
+                dir_names.remove(name)
+                file_names.append(name)
+
+        # Directories are listed once os.walk() descends into them
+        for name in [""] + sorted(file_names):
+            path = os.path.join(root, name) if name else root
+            st = os.lstat(path)
+            entry = {
+                "path": os.path.relpath(path, src_dir),
+                "mode": stat.S_IMODE(st.st_mode),
+                "mtime_ns": st.st_mtime_ns,
+            }
+            if stat.S_ISDIR(st.st_mode):
+                entry["type"] = "dir"
+            elif stat.S_ISLNK(st.st_mode):
+                entry["type"] = "symlink"
+                entry["target"] = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                entry.update(type="file", size=st.st_size, pieces=[])
+            else:
+                continue
+
+            entries.append(entry)
+
+    return entries
+
+
+def read_block(
+    src_dir: str, entries: List[Dict[str, Any]], pieces: List[Piece]
+) -> bytes:
+    data = bytearray()
+    for index, offset, length in pieces:
+        path = entries[index]["path"]
+        with open(os.path.join(src_dir, path), "rb") as fp:
+            fp.seek(offset)
+            piece = fp.read(length)
+
+        # The index already records the size the file had when it was listed
+        massert(len(piece) == length, f"File {path} shrunk while backing it up")
+        data += piece
+
+    return bytes(data)
+
+
+def plan_blocks(entries: List[Dict[str, Any]]) -> List[List[Piece]]:
+    blocks: List[List[Piece]] = []
+    block: List[Piece] = []
+    block_size = 0
+    for index, entry in enumerate(entries):
+        if entry["type"] != "file":
+            continue
+
+        offset = 0
+        while offset < entry["size"]:
+            length = min(entry["size"] - offset, BLOCK_SIZE - block_size)
+            block.append((index, offset, length))
+            block_size += length
+            offset += length
+            if block_size >= BLOCK_SIZE:
+                blocks.append(block)
+                block = []
+                block_size = 0
+
+    if block:
+        blocks.append(block)
+
+    return blocks
+
+
+def write_archive(
+    src_dir: str,
+    fp: BinaryIO,
+    skip_dir: str,
+    compression: str,
+    level: int,
+    jobs: int,
+) -> BackupStats:
+    start = time.monotonic()
+    compress, _ = get_codec(compression, level)
+    entries = scan_files(src_dir, skip_dir)
+    blocks = plan_blocks(entries)
+    block_index: List[List[int]] = []
+    raw_bytes = 0
+
+    def compress_block(pieces: List[Piece]) -> Tuple[bytes, int]:
+        data = read_block(src_dir, entries, pieces)
+        return compress(data), len(data)
+
+    def write_block(future: "Future[Tuple[bytes, int]]") -> None:
+        nonlocal raw_bytes
+        data, raw_size = future.result()
+        block_index.append([fp.tell(), len(data), raw_size])
+        fp.write(data)
+        raw_bytes += raw_size
+
+    fp.write(BACKUP_MAGIC)
+    # Only a couple of blocks per worker are in memory at once, written out
+    # in order as they complete.
+    pending: Deque["Future[Tuple[bytes, int]]"] = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for number, pieces in enumerate(blocks):
+            if len(pending) >= jobs * 2:
+                write_block(pending.popleft())
+
+            pending.append(executor.submit(compress_block, pieces))
+            for index, offset, length in pieces:
+                entries[index]["pieces"].append([number, offset, length])
+
+        while pending:
+            write_block(pending.popleft())
+
+    index_offset = fp.tell()
+    fp.write(
+        zlib.compress(
+            json.dumps(
+                {"compression": compression, "blocks": block_index, "files": entries}
+            ).encode("utf-8")
+        )
+    )
+    fp.write(TRAILER.pack(index_offset, BACKUP_MAGIC))
+    return BackupStats(
+        files=len(entries),
+        raw_bytes=raw_bytes,
+        compressed_bytes=fp.tell(),
+        seconds=time.monotonic() - start,
+    )
+
+
+def read_archive_index(fp: BinaryIO) -> Dict[str, Any]:
+    size = fp.seek(0, os.SEEK_END)
+    massert(size >= len(BACKUP_MAGIC) + TRAILER.size, "Backup archive is truncated")
+    fp.seek(size - TRAILER.size)
+    index_offset, magic = TRAILER.unpack(fp.read(TRAILER.size))
+    massert(magic == BACKUP_MAGIC, "Not an mctl backup archive")
+    fp.seek(index_offset)
+    return json.loads(zlib.decompress(fp.read(size - TRAILER.size - index_offset)))
+
+
+def restore_archive(archive_path: str, dest_dir: str, jobs: int) -> BackupStats:
+    start = time.monotonic()
+    with open(archive_path, "rb") as fp:
+        index = read_archive_index(fp)
+
+    _, decompress = get_codec(index["compression"], 0)
+    entries = index["files"]
+    # Blocks are decompressed in any order, so every file needs to exist at
+    # its full size up front for the pieces to be written into place.
+    for entry in entries:
+        path = os.path.join(dest_dir, entry["path"])
+        if entry["type"] == "dir":
+            os.makedirs(path, exist_ok=True)
+        elif entry["type"] == "file":
+            with open(path, "wb") as dest_fp:
+                dest_fp.truncate(entry["size"])
+
+    block_pieces: List[List[Piece]] = [[] for _ in index["blocks"]]
+    for file_index, entry in enumerate(entries):
+        for number, offset, length in entry.get("pieces", []):
+            block_pieces[number].append((file_index, offset, length))
+
+    archive_fd = os.open(archive_path, os.O_RDONLY)
+
+    def restore_block(number: int) -> int:
+        offset, size, raw_size = index["blocks"][number]
+        data = memoryview(decompress(os.pread(archive_fd, size, offset)))
+        massert(len(data) == raw_size, f"Backup archive block {number} is corrupt")
+        position = 0
+        for file_index, file_offset, length in block_pieces[number]:
+            path = os.path.join(dest_dir, entries[file_index]["path"])
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                os.pwrite(fd, data[position : position + length], file_offset)
+            finally:
+                os.close(fd)
+
+            position += length
+
+        return raw_size
+
+    raw_bytes = 0
+    pending: Deque["Future[int]"] = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for number in range(len(index["blocks"])):
+                if len(pending) >= jobs * 2:
+                    raw_bytes += pending.popleft().result()
+
+                pending.append(executor.submit(restore_block, number))
+
+            while pending:
+                raw_bytes += pending.popleft().result()
+    finally:
+        os.close(archive_fd)
+
+    # Directories last, so restoring their contents does not bump the times
+    for entry in sorted(entries, key=lambda entry: entry["type"] == "dir"):
+        path = os.path.join(dest_dir, entry["path"])
+        if entry["type"] == "symlink":
+            os.symlink(entry["target"], path)
+            continue
+
+        os.chmod(path, entry["mode"])
+        os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    return BackupStats(
+        files=len(entries),
+        raw_bytes=raw_bytes,
+        compressed_bytes=os.path.getsize(archive_path),
+        seconds=time.monotonic() - start,
+    )
+
+
+async def server_backup(
+    config: Config,
+    server: Server,
+    output_path: str,
+    compression: str = DEFAULT_COMPRESSION,
+    level: int = 0,
+    jobs: int = DEFAULT_BACKUP_JOBS,
+) -> BackupStats:
+    massert(compression in COMPRESSIONS, f"Unknown compression: {compression}")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.tmp"
+    LOG.info("Backing up server %s to %s", server.name, output_path)
+    loop = asyncio.get_running_loop()
+    try:
+        with open(tmp_path, "wb") as fp:
+            async with server_saves_paused(server):
+                stats = await loop.run_in_executor(
+                    None,
+                    write_archive,
+                    server.path,
+                    fp,
+                    os.path.realpath(config.data_path),
+                    compression,
+                    level,
+                    jobs,
+                )
+
+            fp.flush()
+            os.fsync(fp.fileno())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        raise
+
+    os.replace(tmp_path, output_path)
+    log_throughput("Backed up", output_path, stats)
+    return stats
+
+
+async def backup_restore(
+    archive_path: str, dest_dir: str, jobs: int = DEFAULT_BACKUP_JOBS
+) -> BackupStats:
+    massert(
+        not os.path.exists(dest_dir) or not os.listdir(dest_dir),
+        f"Restore path {dest_dir} is not empty",
+    )
+    LOG.info("Restoring %s to %s", archive_path, dest_dir)
+    os.makedirs(dest_dir, exist_ok=True)
+    stats = await asyncio.get_running_loop().run_in_executor(
+        None, restore_archive, archive_path, dest_dir, jobs
+    )
+    log_throughput("Restored", archive_path, stats)
+    return stats
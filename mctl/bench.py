@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from collections import defaultdict
+import functools
+import logging
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Awaitable, Callable, DefaultDict, Dict, List, Optional
+
+from mctl.codec import PacketWriter, read_packet
+from mctl.exception import massert, MctlError
+from mctl.fake_server import (
+    FakeServerLimits,
+    run_fake_server,
+    run_fake_server_workers,
+)
+from mctl.process import get_process_tree, read_process_stats
+from mctl.util import run_event_loop
+
+DEFAULT_BENCH_CONNECTIONS = 50
+DEFAULT_BENCH_DURATION = 10.0
+DEFAULT_BENCH_MIX = "status=40,ping=40,login=10,legacy=6,slow=2,malformed=2"
+# About 180ms measured, with a margin for noisy machines
+DEFAULT_STARTUP_BUDGET = 220.0
+DEFAULT_STARTUP_RUNS = 9
+# Time for each flow to complete before it counts as an error
+FLOW_TIMEOUT = 5.0
+LOG = logging.getLogger(__name__)
+MAX_RESPONSE_LENGTH = 1 << 21
+PERCENTILES = [50, 95, 99]
+# Delay between bytes sent by slow clients
+SLOW_CLIENT_DELAY = 0.01
+# Time for a spawned fake server to start listening
+SPAWN_TIMEOUT = 10.0
+# Modules only a few commands need, which must not be imported at startup
+STARTUP_LAZY_MODULES = ["aiofiles", "aiohttp", "mctl.favicons", "yaml"]
+
+
+def pack_handshake(host: str, port: int, next_state: int) -> memoryview:
+    packet = PacketWriter(0)
+    packet.write_varint(-1)
+    packet.write_str(host)
+    packet.write_short(port)
+    packet.write_varint(next_state)
+    return packet.finish()
+
+
+async def flow_status(host: str, port: int, ping: bool, slow: bool = False) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        data = bytes(pack_handshake(host, port, 1)) + bytes(PacketWriter(0).finish())
+        if slow:
+            for i in range(len(data)):
+                writer.write(data[i : i + 1])
+                await writer.drain()
+                await asyncio.sleep(SLOW_CLIENT_DELAY)
+        else:
+            writer.write(data)
+
+        packet_id, _ = await read_packet(reader, MAX_RESPONSE_LENGTH)
+        massert(packet_id == 0, f"Unexpected status packet ID {packet_id}")
+        if not ping:
+            return
+
+        ping_packet = PacketWriter(1)
+        ping_packet.write_long(1234)
+        writer.write(ping_packet.finish())
+        packet_id, packet = await read_packet(reader, MAX_RESPONSE_LENGTH)
+        massert(packet_id == 1 and packet.read_long() == 1234, "Invalid pong")
+    finally:
+        writer.close()
+
+
+async def flow_login(host: str, port: int) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(pack_handshake(host, port, 2))
+        packet_id, _ = await read_packet(reader, MAX_RESPONSE_LENGTH)
+        massert(packet_id == 0, f"Unexpected disconnect packet ID {packet_id}")
+    finally:
+        writer.close()
+
+
+async def flow_legacy(host: str, port: int) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(b"\xfe\x01")
+        data = await reader.read()
+        massert(data[:1] == b"\xff", "Invalid legacy ping response")
+    finally:
+        writer.close()
+
+
+async def flow_malformed(host: str, port: int) -> None:
+    # A varint which never ends, the server should just close the connection
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(b"\xff" * 6)
+        massert(not await reader.read(), "Server answered a malformed packet")
+    finally:
+        writer.close()
+
+
+FLOWS: Dict[str, Callable[[str, int], Awaitable[None]]] = {
+    "status": lambda host, port: flow_status(host, port, False),
+    "ping": lambda host, port: flow_status(host, port, True),
+    "login": flow_login,
+    "legacy": flow_legacy,
+    "slow": lambda host, port: flow_status(host, port, True, True),
+    "malformed": flow_malformed,
+}
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        massert(name in FLOWS, f"Unknown flow {name}, expected one of {list(FLOWS)}")
+        try:
+            weights[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise MctlError(f"Invalid weight for flow {name}: {weight}")
+
+    massert(sum(weights.values()) > 0, "No flows with a positive weight")
+    return weights
+
+
+def get_percentiles(latencies: List[float]) -> Dict[str, Optional[float]]:
+    latencies = sorted(latencies)
+    return {
+        f"p{percentile}": (
+            latencies[round(percentile / 100 * (len(latencies) - 1))] * 1000
+            if latencies
+            else None
+        )
+        for percentile in PERCENTILES
+    }
+
+
+def get_tree_rss(pid: int) -> Optional[int]:
+    stats = [read_process_stats(child) for child in get_process_tree(pid)]
+    rss = [stat.rss_bytes for stat in stats if stat is not None]
+    return sum(rss) if rss else None
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn_fake_server(port: int, workers: int) -> int:
+    # Forked before the benchmark's own event loop exists. The benchmark
+    # opens all of its connections from one address, so lift the limits.
+    limits = FakeServerLimits(max_connections=1 << 20, rate=1e9, burst=1 << 30)
+    main = functools.partial(run_fake_server, "127.0.0.1", port, limits=limits)
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    logging.getLogger().setLevel(logging.WARNING)
+    code = 0
+    try:
+        if workers > 1:
+            run_fake_server_workers(workers, main)
+        else:
+            run_event_loop(main())
+    except BaseException:
+        LOG.exception("Spawned fake server failed")
+        code = 1
+
+    os._exit(code)
+
+
+async def wait_for_port(host: str, port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise MctlError(f"Nothing listening on {host} port {port}")
+
+        await asyncio.sleep(0.05)
+
+
+async def run_bench_fake_server(
+    host: str,
+    port: int,
+    connections: int,
+    duration: float,
+    mix: Dict[str, float],
+    server_pid: Optional[int] = None,
+) -> Dict[str, Any]:
+    await wait_for_port(host, port, SPAWN_TIMEOUT)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies: DefaultDict[str, List[float]] = defaultdict(list)
+    errors: DefaultDict[str, DefaultDict[str, int]] = defaultdict(
+        lambda: defaultdict(int)
+    )
+    start = time.monotonic()
+    deadline = start + duration
+
+    async def client() -> None:
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            flow_start = time.monotonic()
+            try:
+                await asyncio.wait_for(FLOWS[name](host, port), FLOW_TIMEOUT)
+            except asyncio.TimeoutError:
+                errors[name]["TimeoutError"] += 1
+            except (OSError, asyncio.IncompleteReadError, MctlError) as ex:
+                errors[name][type(ex).__name__] += 1
+            else:
+                latencies[name].append(time.monotonic() - flow_start)
+
+    LOG.info(
+        "Benchmarking %s port %d with %d connections for %.1fs",
+        host,
+        port,
+        connections,
+        duration,
+    )
+    rss_before = get_tree_rss(server_pid) if server_pid else None
+    await asyncio.gather(*[client() for _ in range(connections)])
+    elapsed = time.monotonic() - start
+    rss_after = get_tree_rss(server_pid) if server_pid else None
+
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    total_errors = sum(sum(counts.values()) for counts in errors.values())
+    return {
+        "host": host,
+        "port": port,
+        "connections": connections,
+        "duration": elapsed,
+        "mix": mix,
+        "requests": len(all_latencies),
+        "errors": total_errors,
+        "throughput": len(all_latencies) / elapsed,
+        "latency_ms": get_percentiles(all_latencies),
+        "flows": {
+            name: {
+                "requests": len(latencies[name]),
+                "errors": dict(errors[name]),
+                "latency_ms": get_percentiles(latencies[name]),
+            }
+            for name in names
+        },
+        "server_rss_bytes": {"before": rss_before, "after": rss_after},
+    }
+
+
+def bench_fake_server(
+    host: Optional[str],
+    port: Optional[int],
+    connections: int,
+    duration: float,
+    mix: str,
+    workers: int,
+    server_pid: Optional[int],
+) -> Dict[str, Any]:
+    weights = parse_mix(mix)
+    spawned_pid = None
+    if port is None:
+        host = "127.0.0.1"
+        port = get_free_port()
+        spawned_pid = server_pid = spawn_fake_server(port, workers)
+
+    try:
+        return run_event_loop(
+            run_bench_fake_server(
+                host or "localhost", port, connections, duration, weights, server_pid
+            )
+        )
+    finally:
+        if spawned_pid is not None:
+            os.kill(spawned_pid, signal.SIGTERM)
+            os.waitpid(spawned_pid, 0)
+
+
+def get_python_env() -> Dict[str, str]:
+    # The checkout mctl is running from, rather than any installed copy
+    env = dict(os.environ)
+    source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [source_dir] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    return env
+
+
+def run_python(code: str) -> str:
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        env=get_python_env(),
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return proc.stdout.decode("utf-8")
+
+
+def time_python(code: str, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        run_python(code)
+        times.append((time.monotonic() - start) * 1000)
+
+    return statistics.median(times)
+
+
+def bench_startup(runs: int, budget: float) -> Dict[str, Any]:
+    # Timed against a bare interpreter, leaving only the cost of mctl
+    interpreter_ms = time_python("pass", runs)
+    import_ms = time_python("import mctl.commands", runs)
+    lazy_imported = run_python(
+        "import sys, mctl.commands; "
+        f"print(*[name for name in {STARTUP_LAZY_MODULES!r} if name in sys.modules])"
+    ).split()
+    overhead_ms = import_ms - interpreter_ms
+    return {
+        "runs": runs,
+        "interpreter_ms": interpreter_ms,
+        "import_ms": import_ms,
+        "overhead_ms": overhead_ms,
+        "budget_ms": budget,
+        "lazy_modules_imported": lazy_imported,
+        "ok": overhead_ms <= budget and not lazy_imported,
+    }
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from contextlib import contextmanager
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from mctl.bench import bench_fake_server
+from mctl.codec import PacketReader, PacketWriter
+from mctl.config import Config, get_config_cache_path, load_config
+from mctl.exception import massert, MctlError
+from mctl.package import (
+    archive_build,
+    cleanup_builds,
+    package_build,
+    package_revisions,
+)
+from mctl.server import get_all_active_sessions
+from mctl.util import get_rel_dir_files
+
+DEFAULT_REGRESSION_THRESHOLD = 0.25
+LOG = logging.getLogger(__name__)
+# Stand-in for git, answering the commands used to update and version a
+# repository without touching the network.
+STANDIN_GIT = """#!/bin/sh
+case "$1" in
+    clone) mkdir -p "$4/.git" ;;
+    status) echo "## master...origin/master" ;;
+    rev-parse) echo "abc1234" ;;
+esac
+exit 0
+"""
+# Stand-in for screen, listing one detached session per line of sessions.txt
+STANDIN_SCREEN = """#!/bin/sh
+echo "There are screens on:"
+cat "$(dirname "$0")/sessions.txt"
+exit 1
+"""
+
+BenchCase = Callable[[str, float], Dict[str, float]]
+
+
+def measure(
+    func: Callable[[], Any], repeat: int, setup: Optional[Callable[[], Any]] = None
+) -> float:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def scaled(count: int, scale: float) -> int:
+    return max(int(count * scale), 1)
+
+
+def touch(path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb"):
+        pass
+
+
+def make_config(
+    work_dir: str, servers: int, packages: int, artifacts: int = 3
+) -> Dict[str, Any]:
+    return {
+        "data-path": os.path.join(work_dir, "data"),
+        "max-package-revisions": 5,
+        "servers": {
+            f"server{i}": {
+                "path": os.path.join(work_dir, "servers", f"server{i}"),
+                "command": "java -jar server.jar",
+                "packages": [f"package{i % packages}"],
+            }
+            for i in range(servers)
+        },
+        "packages": {
+            f"package{i}": {
+                "repositories": {
+                    f"repo{i}": {
+                        "url": f"https://example.com/repo{i}.git",
+                        "type": "git",
+                        "committish": "master",
+                    }
+                },
+                "build-commands": ["./build.sh"],
+                "artifacts": {
+                    f"plugins/artifact{j}.jar": rf"build/artifact{j}-[0-9.]+\.jar"
+                    for j in range(artifacts)
+                },
+            }
+            for i in range(packages)
+        },
+    }
+
+
+def make_archive(config: Config, revisions: int) -> List[str]:
+    package = config.get_package("package0")
+    archive_dir = os.path.join(config.data_path, "archive", package.name)
+    revs = [f"{rev:07x}" for rev in range(revisions)]
+    for number, rev in enumerate(revs):
+        for path in package.artifacts:
+            root, ext = os.path.splitext(path)
+            archive_path = os.path.join(archive_dir, f"{root}-{rev}{ext}")
+            touch(archive_path)
+            # Spread the revisions out in time, newest last
+            os.utime(archive_path, (number, number))
+
+    return revs
+
+
+def bench_package_revisions(work_dir: str, scale: float) -> Dict[str, float]:
+    config = Config(make_config(work_dir, 1, 1))
+    revisions = scaled(2000, scale)
+    make_archive(config, revisions)
+    package = config.get_package("package0")
+    return {
+        "revisions": revisions,
+        "seconds": measure(lambda: package_revisions(config, package), 5),
+    }
+
+
+def bench_cleanup_builds(work_dir: str, scale: float) -> Dict[str, float]:
+    servers = scaled(50, scale)
+    config = Config(make_config(work_dir, servers, 1))
+    package = config.get_package("package0")
+    revisions = scaled(2000, scale)
+
+    def setup() -> None:
+        # Every server runs the newest revision, the rest are removed
+        revs = make_archive(config, revisions)
+        for server in config.servers.values():
+            for path in package.artifacts:
+                root, ext = os.path.splitext(path)
+                link_path = os.path.join(server.path, path)
+                if not os.path.lexists(link_path):
+                    os.makedirs(os.path.dirname(link_path), exist_ok=True)
+                    os.symlink(
+                        os.path.join(
+                            config.data_path,
+                            "archive",
+                            package.name,
+                            f"{root}-{revs[-1]}{ext}",
+                        ),
+                        link_path,
+                    )
+
+    return {
+        "revisions": revisions,
+        "servers": servers,
+        "seconds": measure(lambda: cleanup_builds(config, package), 3, setup),
+    }
+
+
+def make_build_tree(build_dir: str, files: int) -> None:
+    for i in range(files):
+        touch(os.path.join(build_dir, f"dir{i % 200}", f"sub{i % 7}", f"file{i}.class"))
+
+
+def bench_get_rel_dir_files(work_dir: str, scale: float) -> Dict[str, float]:
+    build_dir = os.path.join(work_dir, "build")
+    files = scaled(20000, scale)
+    make_build_tree(build_dir, files)
+    return {
+        "files": files,
+        "seconds": measure(lambda: get_rel_dir_files(build_dir), 5),
+    }
+
+
+def bench_archive_build(work_dir: str, scale: float) -> Dict[str, float]:
+    config = Config(make_config(work_dir, 1, 1))
+    package = config.get_package("package0")
+    build_dir = os.path.join(work_dir, "build")
+    files = scaled(20000, scale)
+    make_build_tree(build_dir, files)
+    revs = iter(range(1 << 30))
+
+    def setup() -> None:
+        for j in range(len(package.artifacts)):
+            touch(os.path.join(build_dir, "build", f"artifact{j}-1.0.jar"))
+
+    return {
+        "files": files,
+        "seconds": measure(
+            lambda: archive_build(config, package, build_dir, f"{next(revs):07x}"),
+            5,
+            setup,
+        ),
+    }
+
+
+def bench_load_config(work_dir: str, scale: float) -> Dict[str, float]:
+    import yaml
+
+    config_file = os.path.join(work_dir, "config.yml")
+    servers = scaled(500, scale)
+    with open(config_file, "w") as fp:
+        yaml.safe_dump(make_config(work_dir, servers, scaled(300, scale)), fp)
+
+    def remove_cache() -> None:
+        cache_path = get_config_cache_path(config_file)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def load() -> None:
+        asyncio.run(load_config(config_file))
+
+    return {
+        "servers": servers,
+        "seconds": measure(load, 5, remove_cache),
+        "cached_seconds": measure(load, 5),
+    }
+
+
+def bench_codec(work_dir: str, scale: float) -> Dict[str, float]:
+    count = scaled(100000, scale)
+    text = "mctl" * 16
+
+    def run() -> None:
+        packet = PacketWriter(0, count * 8)
+        for i in range(count):
+            packet.write_varint(i * 131)
+            if i % 8 == 0:
+                packet.write_str(text)
+
+        reader = PacketReader(packet.finish())
+        reader.read_varint()
+        reader.read_varint()
+        for i in range(count):
+            reader.read_varint()
+            if i % 8 == 0:
+                reader.read_str()
+
+    return {"values": count, "seconds": measure(run, 5)}
+
+
+def bench_active_sessions(work_dir: str, scale: float) -> Dict[str, float]:
+    servers = scaled(200, scale)
+    config = Config(make_config(work_dir, servers, 1))
+    bin_dir = os.path.join(work_dir, "bin")
+    with open(os.path.join(bin_dir, "sessions.txt"), "w") as fp:
+        for i, name in enumerate(config.servers):
+            fp.write(f"\t{1000 + i}.mctl-{name}\t(Detached)\n")
+
+    servers_list = list(config.servers.values())
+    return {
+        "servers": servers,
+        "seconds": measure(
+            lambda: asyncio.run(get_all_active_sessions(servers_list)), 5
+        ),
+    }
+
+
+def bench_package_build(work_dir: str, scale: float) -> Dict[str, float]:
+    config = Config(make_config(work_dir, 1, 1))
+    package = config.get_package("package0")
+    build_dir = os.path.join(config.data_path, "builds", package.name)
+    os.makedirs(build_dir)
+    with open(os.path.join(build_dir, "build.sh"), "w") as fp:
+        fp.write("#!/bin/sh\nmkdir -p build\n")
+        for j in range(len(package.artifacts)):
+            fp.write(f"touch build/artifact{j}-1.0.jar\n")
+
+    os.chmod(os.path.join(build_dir, "build.sh"), 0o755)
+
+    async def build() -> None:
+        await package_build(config, package, True)
+
+    return {"seconds": measure(lambda: asyncio.run(build()), 3)}
+
+
+def bench_fake_server_ping(work_dir: str, scale: float) -> Dict[str, float]:
+    results = bench_fake_server(None, None, 50, 3 * scale, "ping=1", 1, None)
+    massert(results["requests"] > 0, "No fake server pings completed")
+    return {
+        "throughput": results["throughput"],
+        "errors": results["errors"],
+        # Time per thousand pings, so lower is better like the other cases
+        "seconds": 1000 / results["throughput"],
+    }
+
+
+BENCH_CASES: Dict[str, BenchCase] = {
+    "package-revisions": bench_package_revisions,
+    "cleanup-builds": bench_cleanup_builds,
+    "get-rel-dir-files": bench_get_rel_dir_files,
+    "archive-build": bench_archive_build,
+    "load-config": bench_load_config,
+    "codec": bench_codec,
+    "active-sessions": bench_active_sessions,
+    "package-build": bench_package_build,
+    "fake-server-ping": bench_fake_server_ping,
+}
+
+
+@contextmanager
+def standin_env(work_dir: str) -> Iterator[None]:
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    for name, script in [("git", STANDIN_GIT), ("screen", STANDIN_SCREEN)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as fp:
+            fp.write(script)
+
+        os.chmod(path, 0o755)
+
+    touch(os.path.join(bin_dir, "sessions.txt"))
+    # The config cache is kept out of the user's cache directory as well
+    saved = {name: os.environ.get(name) for name in ["PATH", "XDG_CACHE_HOME"]}
+    os.environ["PATH"] = os.pathsep.join([bin_dir, os.environ.get("PATH", "")])
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def compare_baseline(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+) -> List[str]:
+    regressed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base.get("seconds"):
+            continue
+
+        result["baseline_seconds"] = base["seconds"]
+        result["change"] = result["seconds"] / base["seconds"] - 1
+        if result["change"] > threshold:
+            regressed.append(name)
+
+    return regressed
+
+
+def run_bench_suite(
+    cases: List[str],
+    scale: float,
+    baseline_path: str,
+    save_baseline: bool = False,
+    threshold: float = DEFAULT_REGRESSION_THRESHOLD,
+) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name in cases or list(BENCH_CASES):
+        massert(name in BENCH_CASES, f"Unknown benchmark case: {name}")
+        work_dir = tempfile.mkdtemp(prefix=f"mctl-bench-{name}-")
+        try:
+            with standin_env(work_dir):
+                LOG.info("Running benchmark case %s", name)
+                results[name] = BENCH_CASES[name](work_dir, scale)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        LOG.info("Benchmark case %s took %.6fs", name, results[name]["seconds"])
+
+    baseline: Dict[str, Any] = {}
+    if os.path.exists(baseline_path):
+        try:
+            with open(baseline_path) as fp:
+                baseline = json.load(fp)
+        except (OSError, ValueError) as ex:
+            raise MctlError(f"Failed to read baseline {baseline_path}: {ex}")
+
+    # Baselines are only comparable at the same scale
+    regressed: List[str] = []
+    if baseline.get("scale") == scale:
+        regressed = compare_baseline(results, baseline.get("cases", {}), threshold)
+    elif baseline:
+        LOG.warning("Baseline %s is for a different scale, ignoring", baseline_path)
+
+    if save_baseline:
+        cases_baseline = (
+            baseline.get("cases", {}) if baseline.get("scale") == scale else {}
+        )
+        cases_baseline.update(results)
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w") as fp:
+            json.dump({"scale": scale, "cases": cases_baseline}, fp, indent=2)
+
+        LOG.info("Saved benchmark baseline to %s", baseline_path)
+
+    return {
+        "scale": scale,
+        "threshold": threshold,
+        "cases": results,
+        "regressed": regressed,
+    }
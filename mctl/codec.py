@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import json
+import struct
+from typing import Any, Dict, Optional, Tuple, Union
+
+from mctl.exception import MctlError
+
+# Packet ID of the pre-1.7 server list ping and the kick packet answering it
+LEGACY_KICK_ID = 0xFF
+LEGACY_PING_ID = 0xFE
+# Room left in front of a packet for its length, the longest varint
+LENGTH_PREFIX_SIZE = 5
+MAX_VARINT_SIZE = 5
+SHORT = struct.Struct(">H")
+LONG = struct.Struct(">q")
+
+
+class ProtocolError(MctlError):
+    pass
+
+
+class PacketReader:
+    def __init__(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def remaining(self) -> int:
+        return len(self.view) - self.offset
+
+    def read_bytes(self, length: int) -> memoryview:
+        if self.remaining() < length:
+            raise ProtocolError(f"Packet too short for {length} bytes")
+
+        value = self.view[self.offset : self.offset + length]
+        self.offset += length
+        return value
+
+    def read_long(self) -> int:
+        if self.remaining() < LONG.size:
+            raise ProtocolError("Failed to read long value")
+
+        (value,) = LONG.unpack_from(self.view, self.offset)
+        self.offset += LONG.size
+        return value
+
+    def read_short(self) -> int:
+        if self.remaining() < SHORT.size:
+            raise ProtocolError("Failed to read short value")
+
+        (value,) = SHORT.unpack_from(self.view, self.offset)
+        self.offset += SHORT.size
+        return value
+
+    def read_str(self) -> str:
+        length = self.read_varint()
+        if self.remaining() < length:
+            raise ProtocolError("String too long for packet")
+
+        try:
+            return str(self.read_bytes(length), "utf-8")
+        except UnicodeDecodeError as ex:
+            raise ProtocolError(f"Invalid string: {ex}")
+
+    def read_varint(self) -> int:
+        value = 0
+        view = self.view
+        for shift in range(0, MAX_VARINT_SIZE * 7, 7):
+            if self.offset >= len(view):
+                raise ProtocolError("Packet too short for varint")
+
+            byte = view[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        else:
+            raise ProtocolError("Malformed varint")
+
+        # At or over bit 31 (sign bit) means it's a negative number
+        if value >= 1 << 31:
+            value -= 1 << 32
+
+        return value
+
+
+class PacketWriter:
+    def __init__(self, packet_id: int, size_hint: int = 64) -> None:
+        self.buffer = bytearray(LENGTH_PREFIX_SIZE + size_hint)
+        self.length = LENGTH_PREFIX_SIZE
+        self.write_varint(packet_id)
+
+    def reserve(self, length: int) -> None:
+        if self.length + length > len(self.buffer):
+            self.buffer.extend(bytes(max(length, len(self.buffer))))
+
+    def write_bytes(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.reserve(len(data))
+        self.buffer[self.length : self.length + len(data)] = data
+        self.length += len(data)
+
+    def write_long(self, value: int) -> None:
+        self.reserve(LONG.size)
+        LONG.pack_into(self.buffer, self.length, value)
+        self.length += LONG.size
+
+    def write_short(self, value: int) -> None:
+        self.reserve(SHORT.size)
+        SHORT.pack_into(self.buffer, self.length, value)
+        self.length += SHORT.size
+
+    def write_str(self, value: str) -> None:
+        data = value.encode("utf-8")
+        self.write_varint(len(data))
+        self.write_bytes(data)
+
+    def write_varint(self, value: int) -> None:
+        self.reserve(MAX_VARINT_SIZE)
+        self.length = pack_varint_into(self.buffer, self.length, value)
+
+    def finish(self) -> memoryview:
+        # The length goes into the room left in front of the packet, so the
+        # packet never needs to be copied to prepend it.
+        body_length = self.length - LENGTH_PREFIX_SIZE
+        prefix = bytearray(MAX_VARINT_SIZE)
+        prefix_length = pack_varint_into(prefix, 0, body_length)
+        start = LENGTH_PREFIX_SIZE - prefix_length
+        self.buffer[start:LENGTH_PREFIX_SIZE] = prefix[:prefix_length]
+        return memoryview(self.buffer)[start : self.length]
+
+
+def pack_varint_into(buffer: bytearray, offset: int, value: int) -> int:
+    # Negative numbers are sent as their unsigned 32-bit representation
+    value &= 0xFFFFFFFF
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            buffer[offset] = byte | 0x80
+            offset += 1
+        else:
+            buffer[offset] = byte
+            return offset + 1
+
+
+def pack_json_packet(packet_id: int, value: Dict[str, Any]) -> bytes:
+    # Explicitly avoid any sort of white-spacing in the JSON. The client cannot
+    # parse the JSON with any white-spacing outside of a JSON string.
+    data = json.dumps(value, indent=None, separators=(",", ":"))
+    packet = PacketWriter(packet_id, len(data) + MAX_VARINT_SIZE)
+    packet.write_str(data)
+    return bytes(packet.finish())
+
+
+def pack_legacy_kick(text: str) -> bytes:
+    data = text.encode("utf-16-be")
+    # The length is in UTF-16 code units rather than bytes
+    return bytes([LEGACY_KICK_ID]) + SHORT.pack(len(data) // 2) + data
+
+
+async def read_varint(
+    reader: asyncio.StreamReader, first_byte: Optional[int] = None
+) -> int:
+    value = 0
+    for shift in range(0, MAX_VARINT_SIZE * 7, 7):
+        if first_byte is not None:
+            byte = first_byte
+            first_byte = None
+        else:
+            # The reader is buffered, so this does not make a syscall per byte
+            byte = (await reader.readexactly(1))[0]
+
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value
+
+    raise ProtocolError("Malformed varint")
+
+
+async def read_packet(
+    reader: asyncio.StreamReader, max_length: int, first_byte: Optional[int] = None
+) -> Tuple[int, PacketReader]:
+    try:
+        length = await read_varint(reader, first_byte)
+        # Comparison against a maximum to avoid a memory DoS
+        if length < 1 or length > max_length:
+            raise ProtocolError(f"Invalid packet length: {length}")
+
+        packet = PacketReader(await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed before the packet was read")
+
+    return packet.read_varint(), packet
@@ -14,28 +14,87 @@
 
 import sys
 
+import asyncio
 import click
+import functools
+import json
 import logging
 import os
+import re
 import time
-from typing import Any, Callable, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
-from mctl.config import Config, load_config, Package, Server
+from mctl.backup import (
+    backup_restore,
+    COMPRESSIONS,
+    DEFAULT_BACKUP_JOBS,
+    DEFAULT_COMPRESSION,
+    get_backups_dir,
+    server_backup,
+)
+from mctl.bench import (
+    bench_fake_server,
+    bench_startup,
+    DEFAULT_BENCH_CONNECTIONS,
+    DEFAULT_BENCH_DURATION,
+    DEFAULT_BENCH_MIX,
+    DEFAULT_STARTUP_BUDGET,
+    DEFAULT_STARTUP_RUNS,
+)
+from mctl.benchmarks import (
+    BENCH_CASES,
+    DEFAULT_REGRESSION_THRESHOLD,
+    run_bench_suite,
+)
+from mctl.config import Config, load_config, load_config_names, Package, Server
 from mctl.exception import MctlError
+from mctl.fake_host import run_fake_host
 from mctl.fake_server import (
+    DEFAULT_BURST,
+    DEFAULT_HANDSHAKE_TIMEOUT,
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_MAX_CONNECTIONS,
     DEFAULT_MESSAGE,
     DEFAULT_MOTD,
     DEFAULT_PORT,
+    DEFAULT_RATE,
+    FakeServerLimits,
     run_fake_server,
+    run_fake_server_workers,
+)
+from mctl.idle import DEFAULT_IDLE_INTERVAL, run_idle_watcher
+from mctl.logs import follow_log, get_log_path, LogTailer, tail_lines
+from mctl.metrics import (
+    DEFAULT_METRICS_PORT,
+    DEFAULT_METRICS_TTL,
+    run_metrics_server,
 )
 from mctl.package import (
     package_build,
     package_revisions,
-    package_upgrade,
+    packages_rollback,
+    packages_upgrade,
     sort_revisions_n2o,
 )
-from mctl.server import server_execute, server_start, server_start_fake, server_stop
-from mctl.util import await_sync
+from mctl.ping import DEFAULT_PING_TIMEOUT
+from mctl.profiling import Profiler, span, start_profiler
+from mctl.region import (
+    DEFAULT_REGION_JOBS,
+    server_region_backup,
+    server_region_restore,
+)
+from mctl.server import (
+    get_all_active_sessions,
+    get_fake_request,
+    server_execute,
+    server_start,
+    server_start_fake,
+    server_status,
+    server_stop,
+)
+from mctl.snapshot import DEFAULT_SNAPSHOT_JOBS, server_snapshot
+from mctl.top import DEFAULT_TOP_INTERVAL, run_top, SORT_KEYS
+from mctl.util import await_sync, run_event_loop
 
 DEFAULT_CONFIG_FILE = os.path.expanduser(os.path.join("~", ".mctl/config.yml"))
 LOG = logging.getLogger(__name__)
@@ -87,28 +146,26 @@ def get_packages(
     return packages
 
 
-@await_sync
-async def shell_complete_package_name(
+def shell_complete_package_name(
     context: click.Context, param: click.Parameter, incomplete: str
 ) -> List[str]:
     try:
-        config = await load_config(DEFAULT_CONFIG_FILE)
+        _, packages = load_config_names(DEFAULT_CONFIG_FILE)
     except Exception:
         return []
 
-    return [package for package in config.packages if package.startswith(incomplete)]
+    return [package for package in packages if package.startswith(incomplete)]
 
 
-@await_sync
-async def shell_complete_server_name(
+def shell_complete_server_name(
     context: click.Context, param: click.Parameter, incomplete: str
 ) -> List[str]:
     try:
-        config = await load_config(DEFAULT_CONFIG_FILE)
+        servers, _ = load_config_names(DEFAULT_CONFIG_FILE)
     except Exception:
         return []
 
-    return [server for server in config.servers if server.startswith(incomplete)]
+    return [server for server in servers if server.startswith(incomplete)]
 
 
 @click.group(help="Minecraft server controller", cls=MctlRootGroup)
@@ -125,14 +182,296 @@ async def shell_complete_server_name(
     help="Show debugging messages",
     is_flag=True,
 )
+@click.option(
+    "--profile",
+    "-P",
+    help="Show where the time of the command went once it finishes",
+    is_flag=True,
+)
+@click.option(
+    "--profile-stats",
+    help="Profile the command with cProfile, writing the stats to a file",
+    envvar="FILE",
+)
+@click.option(
+    "--profile-trace",
+    help="Write the timings of the command to a Chrome trace event file",
+    envvar="FILE",
+)
 @click.pass_context
 @await_sync
-async def cli(ctx: click.Context, config_file: str, debug: bool) -> None:
+async def cli(
+    ctx: click.Context,
+    config_file: str,
+    debug: bool,
+    profile: bool,
+    profile_stats: Optional[str],
+    profile_trace: Optional[str],
+) -> None:
     logging.basicConfig(
         format="[%(asctime)s] [%(levelname)s] %(message)s",
         level=logging.DEBUG if debug else logging.INFO,
     )
-    ctx.obj = await load_config(config_file)
+    if profile or profile_stats or profile_trace:
+        profiler = start_profiler(
+            f"mctl {ctx.invoked_subcommand}", profile_stats is not None
+        )
+        ctx.call_on_close(
+            functools.partial(write_profile, profiler, profile_stats, profile_trace)
+        )
+
+    with span("load config"):
+        ctx.obj = await load_config(config_file)
+
+
+def write_profile(
+    profiler: Profiler, stats_file: Optional[str], trace_file: Optional[str]
+) -> None:
+    profiler.finish()
+    click.echo(profiler.summary(), err=True)
+    if stats_file:
+        profiler.write_stats(stats_file)
+
+    if trace_file:
+        profiler.write_trace(trace_file)
+
+
+@cli.command(help="Back up a server to a compressed archive")
+@click.option(
+    "--compression",
+    "-c",
+    help="Compression algorithm to use",
+    default=DEFAULT_COMPRESSION,
+    type=click.Choice(COMPRESSIONS),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of blocks to compress in parallel",
+    envvar="JOBS",
+    default=DEFAULT_BACKUP_JOBS,
+    type=int,
+)
+@click.option(
+    "--level",
+    "-l",
+    help="Compression level (0 uses the default of the algorithm)",
+    default=0,
+    type=int,
+)
+@click.option(
+    "--output",
+    "-o",
+    help="Path of the archive (default: in <data-path>/backups/<server>)",
+    envvar="OUTPUT",
+)
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name of the server to act on",
+    envvar="SERVER",
+    required=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.pass_obj
+@await_sync
+async def backup(
+    config: Config,
+    compression: str,
+    jobs: int,
+    level: int,
+    output: Optional[str],
+    server_name: str,
+) -> None:
+    server = config.get_server(server_name)
+    if output is None:
+        output = os.path.join(
+            get_backups_dir(config, server), time.strftime("%Y%m%d-%H%M%S.mctlbak")
+        )
+
+    await server_backup(config, server, output, compression, level, jobs)
+
+
+def write_results(results: Dict[str, Any], output: Optional[str]) -> None:
+    text = json.dumps(results, indent=2)
+    if output is None:
+        click.echo(text)
+        return
+
+    with open(output, "w") as fp:
+        fp.write(text + "\n")
+
+
+@cli.group(help="Benchmark parts of mctl", cls=MctlRootGroup)
+def bench() -> None:
+    pass
+
+
+@bench.command("fake-server", help="Generate load against a fake server")
+@click.option(
+    "--connections",
+    "-n",
+    help="Number of concurrent connections",
+    default=DEFAULT_BENCH_CONNECTIONS,
+    type=int,
+)
+@click.option(
+    "--duration",
+    "-t",
+    help="Time (in seconds) to generate load for",
+    default=DEFAULT_BENCH_DURATION,
+    type=float,
+)
+@click.option(
+    "--host",
+    "-l",
+    help="Host of the fake server (with --port)",
+    envvar="ADDRESS",
+)
+@click.option(
+    "--mix",
+    "-x",
+    help="Comma separated weights of the flows to run (ex: status=1,ping=2)",
+    default=DEFAULT_BENCH_MIX,
+)
+@click.option(
+    "--output",
+    "-o",
+    help="File to write the JSON results to instead of stdout",
+    envvar="FILE",
+)
+@click.option(
+    "--port",
+    "-p",
+    help="Port of a running fake server (default: spawn a local one)",
+    envvar="PORT",
+    type=int,
+)
+@click.option(
+    "--server-pid",
+    help="PID of the running fake server to report the memory usage of",
+    type=int,
+)
+@click.option(
+    "--workers",
+    "-w",
+    help="Number of workers for the spawned fake server",
+    default=1,
+    type=int,
+)
+def bench_fake_server_command(
+    connections: int,
+    duration: float,
+    host: Optional[str],
+    mix: str,
+    output: Optional[str],
+    port: Optional[int],
+    server_pid: Optional[int],
+    workers: int,
+) -> None:
+    results = bench_fake_server(
+        host, port, connections, duration, mix, workers, server_pid
+    )
+    write_results(results, output)
+
+
+@bench.command("startup", help="Check the import time of mctl against a budget")
+@click.option(
+    "--budget",
+    "-b",
+    help="Time (in milliseconds) importing mctl may add to interpreter startup",
+    default=DEFAULT_STARTUP_BUDGET,
+    type=float,
+)
+@click.option(
+    "--output",
+    "-o",
+    help="File to write the JSON results to instead of stdout",
+    envvar="FILE",
+)
+@click.option(
+    "--runs",
+    "-n",
+    help="Number of times to start the interpreter",
+    default=DEFAULT_STARTUP_RUNS,
+    type=int,
+)
+def bench_startup_command(budget: float, output: Optional[str], runs: int) -> None:
+    results = bench_startup(runs, budget)
+    write_results(results, output)
+    if results["lazy_modules_imported"]:
+        raise click.ClickException(
+            "Imported at startup: " + ", ".join(results["lazy_modules_imported"])
+        )
+
+    if not results["ok"]:
+        raise click.ClickException(
+            f"Startup took {results['overhead_ms']:.1f}ms, over the budget of "
+            f"{budget:.1f}ms"
+        )
+
+
+@bench.command("suite", help="Run the benchmark suite against a baseline")
+@click.option(
+    "--baseline",
+    "-b",
+    "baseline_path",
+    help="Baseline file (default: <data-path>/bench/baseline.json)",
+    envvar="FILE",
+)
+@click.option(
+    "--case",
+    "-c",
+    "cases",
+    help="Benchmark case to run (can be specified multiple times)",
+    multiple=True,
+    type=click.Choice(list(BENCH_CASES)),
+)
+@click.option(
+    "--output",
+    "-o",
+    help="File to write the JSON results to instead of stdout",
+    envvar="FILE",
+)
+@click.option(
+    "--save-baseline",
+    "-s",
+    help="Save the results as the new baseline",
+    is_flag=True,
+)
+@click.option(
+    "--scale",
+    "-x",
+    help="Factor to scale the size of every case by",
+    default=1.0,
+    type=float,
+)
+@click.option(
+    "--threshold",
+    "-t",
+    help="Slowdown over the baseline (ex: 0.25 for 25%) counted as a regression",
+    default=DEFAULT_REGRESSION_THRESHOLD,
+    type=float,
+)
+@click.pass_obj
+def bench_suite_command(
+    config: Config,
+    baseline_path: Optional[str],
+    cases: List[str],
+    output: Optional[str],
+    save_baseline: bool,
+    scale: float,
+    threshold: float,
+) -> None:
+    if baseline_path is None:
+        baseline_path = os.path.join(config.data_path, "bench", "baseline.json")
+
+    results = run_bench_suite(cases, scale, baseline_path, save_baseline, threshold)
+    write_results(results, output)
+    if results["regressed"]:
+        raise click.ClickException(
+            "Regressed over the baseline: " + ", ".join(results["regressed"])
+        )
 
 
 @cli.command(help="Build one or more packages")
@@ -204,6 +543,32 @@ async def execute(config: Config, command: List[str], server_name: str) -> None:
 
 
 @cli.command("fake-server", help="Run the fake server in the foreground")
+@click.option(
+    "--bind-timeout",
+    "-b",
+    help="Time (in seconds) to keep retrying to listen while the port is in use",
+    envvar="SECONDS",
+    default=0.0,
+    type=float,
+)
+@click.option(
+    "--burst",
+    help="Connections allowed at once from an address before rate limiting",
+    default=DEFAULT_BURST,
+    type=int,
+)
+@click.option(
+    "--handshake-timeout",
+    help="Time (in seconds) for a connection to send its handshake",
+    default=DEFAULT_HANDSHAKE_TIMEOUT,
+    type=float,
+)
+@click.option(
+    "--idle-timeout",
+    help="Time (in seconds) to wait for each packet after the handshake",
+    default=DEFAULT_IDLE_TIMEOUT,
+    type=float,
+)
 @click.option(
     "--listen-address",
     "-l",
@@ -211,6 +576,12 @@ async def execute(config: Config, command: List[str], server_name: str) -> None:
     envvar="ADDRESS",
 )
 @click.option("--icon-file", "-i", help="PNG icon to use", envvar="FILE")
+@click.option(
+    "--max-connections",
+    help="Maximum number of connections open at once",
+    default=DEFAULT_MAX_CONNECTIONS,
+    type=int,
+)
 @click.option(
     "--message",
     "-m",
@@ -232,17 +603,223 @@ async def execute(config: Config, command: List[str], server_name: str) -> None:
     envvar="PORT",
     default=DEFAULT_PORT,
 )
+@click.option(
+    "--rate",
+    help="Connections per second allowed from an address",
+    default=DEFAULT_RATE,
+    type=float,
+)
+@click.option(
+    "--workers",
+    "-w",
+    help="Number of worker processes sharing the port (limits apply per worker)",
+    envvar="WORKERS",
+    default=1,
+    type=int,
+)
 @click.pass_obj
-@await_sync
-async def fake_server(
+def fake_server(
     config: Config,
+    bind_timeout: float,
+    burst: int,
+    handshake_timeout: float,
+    idle_timeout: float,
     listen_address: Optional[str],
     icon_file: Optional[str],
+    max_connections: int,
     message: str,
     motd: str,
     port: int,
+    rate: float,
+    workers: int,
+) -> None:
+    limits = FakeServerLimits(
+        handshake_timeout=handshake_timeout,
+        idle_timeout=idle_timeout,
+        max_connections=max_connections,
+        rate=rate,
+        burst=burst,
+    )
+    main = functools.partial(
+        run_fake_server,
+        listen_address,
+        port,
+        message,
+        motd,
+        icon_file,
+        bind_timeout,
+        limits,
+    )
+    if workers > 1:
+        run_fake_server_workers(workers, main)
+    else:
+        run_event_loop(main())
+
+
+@cli.command(
+    "fake-server-host",
+    help="Run the fake server host for all offline servers in the foreground",
+)
+@click.pass_context
+def fake_server_host(ctx: click.Context) -> None:
+    config: Config = ctx.obj
+    config_file = ctx.find_root().params["config_file"]
+
+    async def wake(server_name: str) -> None:
+        await server_start(config.get_server(server_name))
+
+    async def reload(server_name: str, message: str) -> Dict[str, Any]:
+        # SIGHUP picks up changes to the config and the server properties
+        nonlocal config
+        config = await load_config(config_file)
+        return await get_fake_request(config.get_server(server_name), message)
+
+    run_event_loop(run_fake_host(wake=wake, reload=reload))
+
+
+@cli.command(
+    "idle-watch",
+    help="Stop servers without players and start their fake servers",
+)
+@click.option(
+    "--count",
+    "-n",
+    help="Number of checks before exiting (0 checks forever)",
+    envvar="COUNT",
+    default=0,
+    type=int,
+)
+@click.option(
+    "--interval",
+    "-i",
+    help="Time (in seconds) between checks",
+    envvar="SECONDS",
+    default=DEFAULT_IDLE_INTERVAL,
+    type=float,
+)
+@click.pass_obj
+@await_sync
+async def idle_watch(config: Config, count: int, interval: float) -> None:
+    await run_idle_watcher(config, interval, count)
+
+
+@cli.command(help="Show the logs of one or more servers")
+@click.option(
+    "--all-servers",
+    "-a",
+    help="Act on all servers",
+    is_flag=True,
+)
+@click.option(
+    "--count",
+    "-n",
+    help="Number of lines to show from the end of the log",
+    envvar="COUNT",
+    default=10,
+    type=int,
+)
+@click.option(
+    "--follow",
+    "-f",
+    help="Follow the log as it is written to",
+    is_flag=True,
+)
+@click.option(
+    "--grep",
+    "-g",
+    help="Only show lines matching this regular expression",
+    envvar="REGEX",
+)
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name(s) of the server to act on (can be specified multiple times)",
+    envvar="SERVER",
+    multiple=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.pass_obj
+@await_sync
+async def logs(
+    config: Config,
+    all_servers: bool,
+    count: int,
+    follow: bool,
+    grep: Optional[str],
+    server_name: List[str],
+) -> None:
+    if all_servers:
+        servers = list(config.servers.values())
+    elif server_name:
+        servers = [config.get_server(name) for name in server_name]
+    else:
+        raise click.UsageError("--all-servers or --server-name required")
+
+    try:
+        pattern = re.compile(grep) if grep else None
+    except re.error as ex:
+        raise click.BadParameter(str(ex), param_hint="--grep")
+
+    def echo(server: Server, line: str) -> None:
+        if len(servers) > 1:
+            line = f"[{server.name}] {line}"
+
+        click.echo(line)
+
+    tailers = [LogTailer(get_log_path(server)) for server in servers]
+    for server, tailer in zip(servers, tailers):
+        # Open before reading the last lines so none are missed when following
+        tailer.open(True)
+        for line in tail_lines(tailer.path, count, pattern, tailer.offset()):
+            echo(server, line)
+
+    async def follow_server(server: Server, tailer: LogTailer) -> None:
+        async for line in follow_log(tailer, pattern):
+            echo(server, line)
+
+    try:
+        if follow:
+            await asyncio.gather(
+                *[
+                    follow_server(server, tailer)
+                    for server, tailer in zip(servers, tailers)
+                ]
+            )
+    finally:
+        for tailer in tailers:
+            tailer.close()
+
+
+@cli.command(help="Serve Prometheus metrics for servers and packages")
+@click.option(
+    "--cache-ttl",
+    "-t",
+    help="Time (in seconds) to cache collected metrics for",
+    envvar="SECONDS",
+    default=DEFAULT_METRICS_TTL,
+    type=float,
+)
+@click.option(
+    "--listen-address",
+    "-l",
+    help="IPv4/IPv6 address to listen on",
+    envvar="ADDRESS",
+)
+@click.option(
+    "--port",
+    "-p",
+    help="Port to listen on",
+    envvar="PORT",
+    default=DEFAULT_METRICS_PORT,
+)
+@click.pass_obj
+@await_sync
+async def metrics(
+    config: Config, cache_ttl: float, listen_address: Optional[str], port: int
 ) -> None:
-    await run_fake_server(listen_address, port, message, motd, icon_file)
+    await run_metrics_server(
+        config, listen_address, port, cache_ttl, min(cache_ttl, DEFAULT_PING_TIMEOUT)
+    )
 
 
 @cli.command(help="List all packages")
@@ -279,6 +856,72 @@ def packages(config: Config) -> None:
         click.echo("")
 
 
+@cli.command(
+    "region-backup", help="Back up the changed region chunks of a server's worlds"
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of files to back up in parallel",
+    envvar="JOBS",
+    default=DEFAULT_REGION_JOBS,
+    type=int,
+)
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name of the server to act on",
+    envvar="SERVER",
+    required=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.pass_obj
+@await_sync
+async def region_backup(config: Config, jobs: int, server_name: str) -> None:
+    server = config.get_server(server_name)
+    await server_region_backup(config, server, jobs)
+
+
+@cli.command(
+    "region-restore", help="Rebuild the worlds of a region backup in an empty directory"
+)
+@click.option(
+    "--backup",
+    "-b",
+    "name",
+    help="Name of the region backup to restore (default: the latest)",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of files to restore in parallel",
+    envvar="JOBS",
+    default=DEFAULT_REGION_JOBS,
+    type=int,
+)
+@click.option(
+    "--path",
+    "-p",
+    help="Directory to restore the worlds to",
+    required=True,
+)
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name of the server to act on",
+    envvar="SERVER",
+    required=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.pass_obj
+@await_sync
+async def region_restore(
+    config: Config, name: Optional[str], jobs: int, path: str, server_name: str
+) -> None:
+    server = config.get_server(server_name)
+    await server_region_restore(config, server, name, path, jobs)
+
+
 @cli.command(help="Restart a server")
 @click.option(
     "--message",
@@ -300,14 +943,63 @@ def packages(config: Config) -> None:
     required=True,
     shell_complete=shell_complete_server_name,
 )
+@click.option(
+    "--wait",
+    "-w",
+    help="Wait for the server to finish starting",
+    is_flag=True,
+)
 @click.pass_obj
 @await_sync
 async def restart(
-    config: Config, message: Optional[str], now: bool, server_name: str
+    config: Config, message: Optional[str], now: bool, server_name: str, wait: bool
 ) -> None:
     server = config.get_server(server_name)
     await server_stop(server, message, not now)
-    await server_start(server)
+    await server_start(server, wait)
+
+
+@cli.command(help="Restore a backup archive to an empty directory")
+@click.option(
+    "--archive",
+    "-a",
+    help="Path of the archive to restore",
+    envvar="ARCHIVE",
+    required=True,
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of blocks to decompress in parallel",
+    envvar="JOBS",
+    default=DEFAULT_BACKUP_JOBS,
+    type=int,
+)
+@click.option(
+    "--path",
+    "-p",
+    help="Directory to restore the archive to",
+    required=True,
+)
+@click.pass_obj
+@await_sync
+async def restore(config: Config, archive: str, jobs: int, path: str) -> None:
+    await backup_restore(archive, path, jobs)
+
+
+@cli.command(help="Roll back the last package upgrade of a server")
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name of the server to act on",
+    envvar="SERVER",
+    required=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.pass_obj
+def rollback(config: Config, server_name: str) -> None:
+    server = config.get_server(server_name)
+    packages_rollback(config, server)
 
 
 @cli.command(help="List all servers")
@@ -318,6 +1010,8 @@ def servers(config: Config) -> None:
         click.echo(f"  Path: {server.path}")
         click.echo(f"  Command: {server.command}")
         click.echo(f"  Stop Timeout: {server.stop_timeout}")
+        click.echo(f"  Start Timeout: {server.start_timeout}")
+        click.echo(f"  Kill Timeout: {server.kill_timeout}")
         click.echo("  Packages:")
 
         for package in server.packages:
@@ -326,6 +1020,30 @@ def servers(config: Config) -> None:
         click.echo("")
 
 
+@cli.command(help="Take an incremental snapshot of a server")
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of files to copy in parallel",
+    envvar="JOBS",
+    default=DEFAULT_SNAPSHOT_JOBS,
+    type=int,
+)
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name of the server to act on",
+    envvar="SERVER",
+    required=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.pass_obj
+@await_sync
+async def snapshot(config: Config, jobs: int, server_name: str) -> None:
+    server = config.get_server(server_name)
+    await server_snapshot(config, server, jobs)
+
+
 @cli.command(help="Start a server")
 @click.option(
     "--fake",
@@ -347,16 +1065,95 @@ def servers(config: Config) -> None:
     required=True,
     shell_complete=shell_complete_server_name,
 )
+@click.option(
+    "--wait",
+    "-w",
+    help="Wait for the server to finish starting",
+    is_flag=True,
+)
 @click.pass_obj
 @await_sync
 async def start(
-    config: Config, fake: bool, fake_message: Optional[str], server_name: str
+    config: Config,
+    fake: bool,
+    fake_message: Optional[str],
+    server_name: str,
+    wait: bool,
 ) -> None:
     server = config.get_server(server_name)
     if fake:
         await server_start_fake(server, fake_message)
     else:
-        await server_start(server)
+        await server_start(server, wait)
+
+
+@cli.command(help="Show the status of one or more servers")
+@click.option(
+    "--json",
+    "-j",
+    "as_json",
+    help="Output the status as JSON",
+    is_flag=True,
+)
+@click.option(
+    "--server-name",
+    "-s",
+    help="Name(s) of the server to act on (defaults to all servers)",
+    envvar="SERVER",
+    multiple=True,
+    shell_complete=shell_complete_server_name,
+)
+@click.option(
+    "--timeout",
+    "-t",
+    help="Timeout (in seconds) to wait for each server to respond",
+    envvar="SECONDS",
+    default=DEFAULT_PING_TIMEOUT,
+    type=float,
+)
+@click.pass_obj
+@await_sync
+async def status(
+    config: Config, as_json: bool, server_name: List[str], timeout: float
+) -> None:
+    if server_name:
+        servers = [config.get_server(name) for name in server_name]
+    else:
+        servers = list(config.servers.values())
+
+    all_sessions = await get_all_active_sessions(servers)
+    statuses = await asyncio.gather(
+        *[
+            server_status(server, all_sessions[server.name], timeout)
+            for server in servers
+        ]
+    )
+
+    if as_json:
+        click.echo(
+            json.dumps(
+                [
+                    {"name": status.name, "fake": status.fake, **status.ping._asdict()}
+                    for status in statuses
+                ],
+                indent=2,
+            )
+        )
+        return
+
+    for status in statuses:
+        result = status.ping
+        if not result.online:
+            click.echo(f"{status.name}: offline ({result.error})")
+            continue
+
+        kind = "fake" if status.fake else "real"
+        click.echo(
+            f"{status.name}: online ({kind}), "
+            f"{result.players_online}/{result.players_max} players, "
+            f"{result.version} (protocol {result.protocol}), "
+            f"{result.latency:.1f} ms"
+        )
 
 
 @cli.command(help="Stop a server")
@@ -396,9 +1193,38 @@ async def stop(
     start_fake: bool,
 ) -> None:
     server = config.get_server(server_name)
-    await server_stop(server, message, not now)
-    if start_fake:
-        await server_start_fake(server, message)
+    await server_stop(server, message, not now, start_fake)
+
+
+@cli.command(help="Show live resource usage of running servers")
+@click.option(
+    "--count",
+    "-n",
+    help="Number of refreshes before exiting (0 refreshes forever)",
+    envvar="COUNT",
+    default=0,
+    type=int,
+)
+@click.option(
+    "--interval",
+    "-i",
+    help="Time (in seconds) between refreshes",
+    envvar="SECONDS",
+    default=DEFAULT_TOP_INTERVAL,
+    type=float,
+)
+@click.option(
+    "--sort",
+    "-o",
+    "sort_key",
+    help="Column to sort servers by",
+    default="cpu",
+    type=click.Choice(SORT_KEYS),
+)
+@click.pass_obj
+@await_sync
+async def top(config: Config, count: int, interval: float, sort_key: str) -> None:
+    await run_top(config, interval, sort_key, count)
 
 
 @cli.command(help="Upgrade one or more packages")
@@ -445,8 +1271,7 @@ async def stop(
     shell_complete=shell_complete_server_name,
 )
 @click.pass_obj
-@await_sync
-async def upgrade(
+def upgrade(
     config: Config,
     all_packages: bool,
     all_except: Optional[List[str]],
@@ -457,5 +1282,4 @@ async def upgrade(
 ) -> None:
     server = config.get_server(server_name)
     packages = get_packages(config, all_packages, all_except, package_name, server)
-    for package in packages:
-        await package_upgrade(config, server, package, revision, force)
+    packages_upgrade(config, server, packages, revision, force)
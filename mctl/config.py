@@ -13,19 +13,19 @@
 # all copies or substantial portions of the Software.
 
 from abc import ABC, abstractmethod
-import aiofiles
+import asyncio
+import hashlib
+import logging
 import os
+import pickle
 import re
-from typing import Any, Dict, List, Mapping, Optional, TYPE_CHECKING, Union
-import yaml
+from typing import Any, Dict, List, Mapping, Optional, Tuple, TYPE_CHECKING, Union
 
 from mctl.exception import massert, MctlError
 
-try:
-    from yaml import CLoader as YamlLoader
-except ImportError:
-    if not TYPE_CHECKING:
-        from yaml import Loader as YamlLoader
+# Bumped whenever the layout of the cached config changes
+CONFIG_CACHE_VERSION = 1
+LOG = logging.getLogger(__name__)
 
 
 def dump_config_object_to_lines(
@@ -41,7 +41,7 @@ def dump_config_object_to_lines(
     lines = []
     indent = "  " * offset
     for key, value in sorted(kvitems, key=lambda kv: kv[0]):
-        if key == "config_dict":
+        if key in ("compiled_artifacts", "config_dict", "config_file"):
             continue
 
         if isinstance(value, (dict, ConfigObject)):
@@ -79,6 +79,14 @@ class ConfigObject(ABC):
         )
         return value
 
+    def get_bool(self, name: str, default: Optional[Any] = None) -> bool:
+        value = self.get_value(name, default)
+        massert(
+            isinstance(value, bool),
+            f"Expected a boolean for config value {name}, got: {value}",
+        )
+        return value
+
     def get_int(self, name: str, default: Optional[Any] = None) -> int:
         value = self.get_value(name, default)
         massert(
@@ -129,9 +137,17 @@ class Package(ConfigObject):
         }
         self.fetch_urls = self.get_dict("fetch-urls", {})
         self.build_commands = self.get_str_list("build-commands")
-        self.artifacts: Dict[str, re.Pattern] = {}
+        self.artifact_regexes: Dict[str, str] = self.get_dict("artifacts")
+        self.compiled_artifacts: Optional[Dict[str, re.Pattern]] = None
 
-        for path, regex in self.get_dict("artifacts").items():
+    @property
+    def artifacts(self) -> Dict[str, re.Pattern]:
+        # Compiled on first use, most commands never look at the artifacts
+        if self.compiled_artifacts is not None:
+            return self.compiled_artifacts
+
+        artifacts = {}
+        for path, regex in self.artifact_regexes.items():
             if not regex.endswith("$"):
                 regex += "$"
 
@@ -140,7 +156,10 @@ class Package(ConfigObject):
             except Exception:
                 raise Exception(f"Invalid artifact regex: {regex}")
 
-            self.artifacts[path] = pattern
+            artifacts[path] = pattern
+
+        self.compiled_artifacts = artifacts
+        return artifacts
 
     def validate(self) -> None:
         massert(self.name != ".archive", "Package cannot be named .archive")
@@ -156,12 +175,27 @@ class Package(ConfigObject):
 
 
 class Server(ConfigObject):
-    def __init__(self, config_dict: Dict[str, Any], name: str) -> None:
+    def __init__(
+        self,
+        config_dict: Dict[str, Any],
+        name: str,
+        config_file: Optional[str] = None,
+    ) -> None:
         super().__init__(config_dict)
         self.name = name
+        # The fake server host loads the same config to wake the server
+        self.config_file = config_file
         self.path = self.get_str("path")
         self.command = self.get_str("command")
         self.stop_timeout = self.get_int("stop-timeout", 60)
+        self.start_timeout = self.get_int("start-timeout", 300)
+        self.kill_timeout = self.get_int("kill-timeout", 120)
+        self.wake_on_join = self.get_bool("wake-on-join", False)
+        self.idle_timeout = self.get_int("idle-timeout", 0)
+        self.idle_cooldown = self.get_int("idle-cooldown", 600)
+        self.idle_message = self.get_str(
+            "idle-message", "The server was stopped while no one was playing"
+        )
         self.packages = self.get_str_list("packages")
 
     def validate(self) -> None:
@@ -169,17 +203,37 @@ class Server(ConfigObject):
             self.stop_timeout >= 0,
             f"Server {self.name} stop timeout must be >= 0: {self.stop_timeout}",
         )
+        massert(
+            self.start_timeout > 0,
+            f"Server {self.name} start timeout must be > 0: {self.start_timeout}",
+        )
+        massert(
+            self.kill_timeout > 0,
+            f"Server {self.name} kill timeout must be > 0: {self.kill_timeout}",
+        )
+        massert(
+            self.idle_timeout >= 0,
+            f"Server {self.name} idle timeout must be >= 0: {self.idle_timeout}",
+        )
+        massert(
+            self.idle_cooldown >= 0,
+            f"Server {self.name} idle cooldown must be >= 0: {self.idle_cooldown}",
+        )
         massert(self.packages, f"Server {self.name} missing packages")
 
 
 class Config(ConfigObject):
-    def __init__(self, config_dict: Dict[str, Any]) -> None:
+    def __init__(
+        self, config_dict: Dict[str, Any], config_file: Optional[str] = None
+    ) -> None:
         super().__init__(config_dict)
+        self.config_file = config_file
         self.data_path = self.get_str("data-path")
         self.build_niceness = self.get_int("build-niceness", 15)
         self.max_package_revisions = self.get_int("max-package-revisions", 5)
+        self.max_snapshots = self.get_int("max-snapshots", 5)
         self.servers = {
-            name: Server(server, name)
+            name: Server(server, name, config_file)
             for name, server in self.get_dict("servers").items()
         }
         self.packages = {
@@ -196,6 +250,10 @@ class Config(ConfigObject):
             self.max_package_revisions >= 1,
             f"Invalid max package revisions (>= 1): {self.max_package_revisions}",
         )
+        massert(
+            self.max_snapshots >= 1,
+            f"Invalid max snapshots (>= 1): {self.max_snapshots}",
+        )
         massert(self.servers, "No servers defined")
         massert(self.servers, "No packages defined")
 
@@ -216,8 +274,87 @@ class Config(ConfigObject):
         return self.servers[name]
 
 
+def get_config_cache_path(config_file: str) -> str:
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        os.path.join("~", ".cache")
+    )
+    path_hash = hashlib.sha1(os.path.abspath(config_file).encode("utf-8"))
+    return os.path.join(cache_dir, "mctl", f"config-{path_hash.hexdigest()}.pickle")
+
+
+def get_config_cache_key(config_file: str, st: os.stat_result) -> Tuple:
+    return (
+        CONFIG_CACHE_VERSION,
+        os.path.abspath(config_file),
+        st.st_mtime_ns,
+        st.st_size,
+    )
+
+
+def read_config_cache(
+    config_file: str, names_only: bool = False
+) -> Optional[Dict[str, Any]]:
+    try:
+        st = os.stat(config_file)
+        with open(get_config_cache_path(config_file), "rb") as fp:
+            # The names index comes first, completion stops reading there
+            cache = pickle.load(fp)
+            if cache.get("key") != get_config_cache_key(config_file, st):
+                return None
+
+            if not names_only:
+                cache["config"] = pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        LOG.debug("Ignoring config cache for %s: %s", config_file, ex)
+        return None
+
+    return cache
+
+
+def write_config_cache(config_file: str, st: os.stat_result, config: Config) -> None:
+    # Only validated configs are cached, after the names needed for shell
+    # completion so it does not need to load the config at all.
+    names = {
+        "key": get_config_cache_key(config_file, st),
+        "servers": list(config.servers),
+        "packages": list(config.packages),
+    }
+    cache_path = get_config_cache_path(config_file)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(names, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(config.config_dict, fp, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, cache_path)
+    except Exception as ex:
+        LOG.debug("Failed to write config cache for %s: %s", config_file, ex)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 async def load_config(config_file: str) -> Config:
+    cache = read_config_cache(config_file)
+    if cache is not None:
+        return Config(cache["config"], os.path.abspath(config_file))
+
+    # Only needed when the cache is stale, parsing is most of the cost anyway
+    import aiofiles
+    import yaml
+
     try:
+        from yaml import CLoader as YamlLoader
+    except ImportError:
+        if not TYPE_CHECKING:
+            from yaml import Loader as YamlLoader
+
+    try:
+        # Taken before reading, a change while reading leaves a stale key
+        # which only causes the config to be read again.
+        st = os.stat(config_file)
         async with aiofiles.open(config_file) as fp:
             config_text = await fp.read()
     except OSError as ex:
@@ -225,6 +362,16 @@ async def load_config(config_file: str) -> Config:
 
     config_dict = yaml.load(config_text, YamlLoader)
     massert(config_dict, "Empty or missing config")
-    config = Config(config_dict)
+    config = Config(config_dict, os.path.abspath(config_file))
     config.validate()
+    write_config_cache(config_file, st, config)
     return config
+
+
+def load_config_names(config_file: str) -> Tuple[List[str], List[str]]:
+    cache = read_config_cache(config_file, True)
+    if cache is None:
+        config = asyncio.run(load_config(config_file))
+        return list(config.servers), list(config.packages)
+
+    return cache["servers"], cache["packages"]
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import fcntl
+import functools
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from mctl.codec import pack_json_packet
+from mctl.exception import MctlError
+from mctl.fake_server import (
+    DEFAULT_MESSAGE,
+    DEFAULT_MOTD,
+    DEFAULT_PORT,
+    FakeServerLimits,
+    FakeService,
+    load_responses,
+    start_server,
+    STOP_SIGNALS,
+)
+from mctl.util import execute_shell_check
+
+# Time for the host to answer a list request, a hung host is treated as
+# having no servers rather than hanging every command which checks it.
+CONTROL_TIMEOUT = 5.0
+FAKE_HOST_SESSION = "mctl-fake-host"
+# Time for a started host to create its control socket
+HOST_START_TIMEOUT = 10.0
+# Time a host with no servers stays around, covering the gap between it
+# being started and the first server being added.
+HOST_IDLE_TIMEOUT = 30.0
+LOG = logging.getLogger(__name__)
+POLL_INTERVAL = 0.05
+WAKE_MESSAGE = "The server is starting, reconnect in ~{seconds}s"
+WAKE_MESSAGE_UNKNOWN = "The server is starting, reconnect shortly"
+
+# (message, MOTD, icon file)
+ResponseOptions = Tuple[str, str, Optional[str]]
+
+
+def get_control_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"mctl-fake-host-{os.getuid()}.sock")
+
+
+def lock_host_start() -> int:
+    # Held while starting the host, so concurrent callers (ex: the idle
+    # watcher stopping several servers at once) start a single host.
+    fd = os.open(f"{get_control_path()}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except OSError:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+def get_response_options(request: Dict[str, Any]) -> ResponseOptions:
+    return (
+        request.get("message") or DEFAULT_MESSAGE,
+        request.get("motd") or DEFAULT_MOTD,
+        request.get("icon_file"),
+    )
+
+
+def pack_wake_login(seconds: Optional[float]) -> bytes:
+    if seconds is None:
+        message = WAKE_MESSAGE_UNKNOWN
+    else:
+        message = WAKE_MESSAGE.format(seconds=max(round(seconds), 1))
+
+    return pack_json_packet(0, {"bold": True, "color": "yellow", "text": message})
+
+
+class FakeListener:
+    def __init__(
+        self,
+        name: str,
+        listen_address: Optional[str],
+        port: int,
+        service: FakeService,
+        options: ResponseOptions,
+        bind_timeout: float,
+    ) -> None:
+        self.name = name
+        self.listen_address = listen_address
+        self.port = port
+        self.service = service
+        self.options = options
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.task = asyncio.ensure_future(self.listen(bind_timeout))
+
+    async def listen(self, bind_timeout: float) -> None:
+        # Binding may need to wait for a stopping server to release the port,
+        # which should not hold up the control request.
+        try:
+            self.server = await start_server(
+                self.service.handle_connection,
+                self.listen_address,
+                self.port,
+                bind_timeout,
+            )
+        except MctlError as ex:
+            LOG.error("Fake server %s failed to start: %s", self.name, ex)
+            raise
+
+        await self.server.start_serving()
+        LOG.info(
+            "Fake server %s listening on %s, port %d",
+            self.name,
+            self.listen_address,
+            self.port,
+        )
+
+    async def reload(self, options: Optional[ResponseOptions] = None) -> None:
+        # The listener and open connections are left alone, only new reads of
+        # the responses see the new ones.
+        options = options or self.options
+        await self.service.reload(*options)
+        self.options = options
+        LOG.info("Fake server %s reloaded", self.name)
+
+    async def close(self) -> None:
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, MctlError):
+            pass
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+        LOG.info("Fake server %s stopped", self.name)
+
+    def info(self) -> Dict[str, Any]:
+        error = None
+        if self.task.done() and not self.task.cancelled():
+            ex = self.task.exception()
+            error = str(ex) if ex else None
+
+        return {
+            "listen_address": self.listen_address,
+            "port": self.port,
+            "listening": self.server is not None,
+            "wake_on_join": self.service.wake is not None,
+            "error": error,
+        }
+
+
+class FakeHost:
+    def __init__(
+        self,
+        limits: FakeServerLimits,
+        wake: Optional[Callable[[str], Awaitable[None]]] = None,
+        reload: Optional[Callable[[str, str], Awaitable[Dict[str, Any]]]] = None,
+    ) -> None:
+        self.limits = limits
+        self.wake = wake
+        # Builds a new request for a server from the config, given its name
+        # and current message.
+        self.reload = reload
+        self.listeners: Dict[str, FakeListener] = {}
+        # Server name to the task starting it and when it was started
+        self.wakes: Dict[str, Tuple["asyncio.Future[None]", float]] = {}
+        self.stopping = asyncio.Event()
+        self.idle_handle: Optional[asyncio.TimerHandle] = None
+        self.control_connections = 0
+
+    def update_idle(self) -> None:
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+
+        # An open control connection is about to add a server, the host must
+        # not exit under it.
+        if not self.listeners and self.control_connections == 0:
+            self.idle_handle = asyncio.get_running_loop().call_later(
+                HOST_IDLE_TIMEOUT, self.stopping.set
+            )
+
+    def get_wake(self, request: Dict[str, Any]) -> Optional[Callable[[], bytes]]:
+        if not request.get("wake_on_join") or self.wake is None:
+            return None
+
+        return functools.partial(
+            self.wake_server,
+            self.wake,
+            request["name"],
+            request.get("startup_seconds"),
+        )
+
+    def wake_server(
+        self,
+        wake_cb: Callable[[str], Awaitable[None]],
+        name: str,
+        startup_seconds: Optional[float],
+    ) -> bytes:
+        # Only the first player to join starts the server, the rest are told
+        # how much longer it should take.
+        wake = self.wakes.get(name)
+        if wake is None or wake[0].done():
+            LOG.info("Waking server %s for a joining player", name)
+            wake = (
+                asyncio.ensure_future(self.run_wake(wake_cb, name)),
+                time.monotonic(),
+            )
+            self.wakes[name] = wake
+
+        if startup_seconds is not None:
+            startup_seconds -= time.monotonic() - wake[1]
+
+        return pack_wake_login(startup_seconds)
+
+    async def run_wake(
+        self, wake_cb: Callable[[str], Awaitable[None]], name: str
+    ) -> None:
+        try:
+            await wake_cb(name)
+        except MctlError as ex:
+            LOG.error("Failed to wake server %s: %s", name, ex)
+
+    async def add(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        name = request["name"]
+        if name in self.listeners:
+            raise MctlError(f"Fake server {name} already running")
+
+        options = get_response_options(request)
+        responses = await load_responses(*options)
+        self.listeners[name] = FakeListener(
+            name,
+            request.get("listen_address"),
+            request.get("port") or DEFAULT_PORT,
+            FakeService(responses, self.limits, self.get_wake(request)),
+            options,
+            request.get("bind_timeout", 0),
+        )
+        self.update_idle()
+        return {}
+
+    async def update(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        name = request["name"]
+        listener = self.listeners.get(name)
+        if listener is None:
+            raise MctlError(f"Fake server {name} not running")
+
+        listen_address = request.get("listen_address")
+        port = request.get("port") or DEFAULT_PORT
+        if (listen_address, port) != (listener.listen_address, listener.port):
+            # A listener cannot be moved, it is replaced by a new one
+            LOG.info("Fake server %s moved to %s, port %d", name, listen_address, port)
+            del self.listeners[name]
+            await listener.close()
+            return await self.add(request)
+
+        await listener.reload(get_response_options(request))
+        listener.service.wake = self.get_wake(request)
+        return {}
+
+    async def reload_all(self) -> None:
+        for name, listener in list(self.listeners.items()):
+            try:
+                if self.reload is None:
+                    await listener.reload()
+                else:
+                    await self.update(await self.reload(name, listener.options[0]))
+            except MctlError as ex:
+                LOG.error("Failed to reload fake server %s: %s", listener.name, ex)
+
+    async def remove(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        name = request["name"]
+        listener = self.listeners.pop(name, None)
+        if listener is None:
+            raise MctlError(f"Fake server {name} not running")
+
+        # The port is free once the response is sent
+        await listener.close()
+        self.update_idle()
+        return {}
+
+    async def list(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "servers": {
+                name: listener.info() for name, listener in self.listeners.items()
+            }
+        }
+
+    async def handle_control(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.control_connections += 1
+        self.update_idle()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise MctlError(f"Invalid request: {request}")
+
+                    handler = {
+                        "add": self.add,
+                        "remove": self.remove,
+                        "update": self.update,
+                        "list": self.list,
+                    }.get(request.get("action", ""))
+                    if handler is None:
+                        raise MctlError(f"Unknown action: {request.get('action')}")
+
+                    response = {"ok": True, **await handler(request)}
+                except (KeyError, ValueError, MctlError) as ex:
+                    response = {"ok": False, "error": str(ex)}
+
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError as ex:
+            LOG.debug("Control connection failed: %s", ex)
+        finally:
+            writer.close()
+            self.control_connections -= 1
+            self.update_idle()
+
+    async def run(self) -> None:
+        path = get_control_path()
+        # A host which did not exit cleanly leaves its socket behind, while
+        # the socket of a running host must be left alone.
+        if os.path.exists(path):
+            try:
+                await send_fake_host_request({"action": "list"})
+            except ConnectionRefusedError:
+                os.remove(path)
+            else:
+                raise MctlError(f"Fake server host already listening on {path}")
+
+        control = await asyncio.start_unix_server(self.handle_control, path)
+        os.chmod(path, 0o600)
+        loop = asyncio.get_running_loop()
+        for sig in STOP_SIGNALS:
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        loop.add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.ensure_future(self.reload_all())
+        )
+
+        LOG.info("Fake server host listening on %s", path)
+        self.update_idle()
+        try:
+            await self.stopping.wait()
+        finally:
+            control.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+            for listener in list(self.listeners.values()):
+                await listener.close()
+
+        LOG.info("Fake server host stopped")
+
+
+async def run_fake_host(
+    limits: FakeServerLimits = FakeServerLimits(),
+    wake: Optional[Callable[[str], Awaitable[None]]] = None,
+    reload: Optional[Callable[[str, str], Awaitable[Dict[str, Any]]]] = None,
+) -> None:
+    await FakeHost(limits, wake, reload).run()
+
+
+async def send_fake_host_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    reader, writer = await asyncio.open_unix_connection(get_control_path())
+    try:
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+
+    if not line:
+        raise MctlError("Fake server host closed the control connection")
+
+    response = json.loads(line)
+    if not response.get("ok"):
+        raise MctlError(response.get("error") or "Fake server host request failed")
+
+    return response
+
+
+async def fake_host_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return await send_fake_host_request(request)
+    except OSError as ex:
+        raise MctlError(f"Failed to reach the fake server host: {ex}")
+
+
+async def get_fake_host_servers() -> Dict[str, Dict[str, Any]]:
+    try:
+        response = await asyncio.wait_for(
+            send_fake_host_request({"action": "list"}), CONTROL_TIMEOUT
+        )
+    except (FileNotFoundError, ConnectionRefusedError):
+        return {}
+    except asyncio.TimeoutError:
+        LOG.warning("Fake server host did not answer after %ss", CONTROL_TIMEOUT)
+        return {}
+    except (OSError, MctlError) as ex:
+        LOG.warning("Failed to list the servers of the fake server host: %s", ex)
+        return {}
+
+    return response["servers"]
+
+
+async def is_fake_host_running() -> bool:
+    try:
+        await asyncio.wait_for(
+            send_fake_host_request({"action": "list"}), CONTROL_TIMEOUT
+        )
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+
+async def ensure_fake_host(config_file: Optional[str] = None) -> None:
+    if await is_fake_host_running():
+        return
+
+    fd = await asyncio.get_running_loop().run_in_executor(None, lock_host_start)
+    try:
+        # Another caller may have started the host while this one waited
+        if await is_fake_host_running():
+            return
+
+        LOG.info("Starting fake server host with screen session %s", FAKE_HOST_SESSION)
+        # The host wakes and reloads servers from the config they came from
+        config_arg = f" -c '{config_file}'" if config_file else ""
+        await execute_shell_check(
+            f"screen -S '{FAKE_HOST_SESSION}' -dm "
+            f"{sys.argv[0]}{config_arg} fake-server-host"
+        )
+        deadline = time.monotonic() + HOST_START_TIMEOUT
+        while not await is_fake_host_running():
+            if time.monotonic() >= deadline:
+                raise MctlError(
+                    f"Fake server host failed to start after {HOST_START_TIMEOUT}s"
+                )
+
+            await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        os.close(fd)
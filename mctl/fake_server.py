@@ -12,156 +12,244 @@
 # The above copyright notice and this permission notice shall be included in
 # all copies or substantial portions of the Software.
 
-import aiofiles
 import asyncio
-import copy
 import base64
+from collections import OrderedDict
+import errno
 import functools
-import json
 import logging
-from typing import Any, Dict, List, Optional, Tuple
-
-from mctl.exception import MctlError
-from mctl.favicons import CAUTION_BASE64
-
+import os
+import signal
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from mctl.codec import (
+    LEGACY_PING_ID,
+    pack_json_packet,
+    pack_legacy_kick,
+    PacketReader,
+    PacketWriter,
+    ProtocolError,
+    read_packet,
+)
+from mctl.exception import massert, MctlError
+from mctl.util import run_event_loop
+
+BIND_RETRY_INTERVAL = 0.05
+DEFAULT_BURST = 10
+DEFAULT_HANDSHAKE_TIMEOUT = 5.0
+DEFAULT_IDLE_TIMEOUT = 10.0
+DEFAULT_MAX_CONNECTIONS = 512
 DEFAULT_MESSAGE = "The server is currently offline!"
 DEFAULT_MOTD = "Server Offline!"
 DEFAULT_PORT = 25565
+DEFAULT_RATE = 2.0
+FAKE_VERSION_NAME = "MCTL"
+# Protocol version sent to legacy clients, which shows the version name in red
+LEGACY_PROTOCOL = 127
+# Time to wait for the byte telling 1.4+ legacy pings apart from older ones
+LEGACY_PING_TIMEOUT = 0.5
 LOG = logging.getLogger(__name__)
+MAX_PACKET_LENGTH = 2048
+# Bound on the number of addresses tracked for rate limiting and log sampling
+MAX_TRACKED_ADDRESSES = 4096
+# Workers exiting quicker than this after being started are restarted after
+# a delay, so a worker which cannot start does not spin.
+WORKER_MIN_UPTIME = 5.0
+WORKER_RESTART_DELAY = 1.0
+STOP_SIGNALS = [signal.SIGINT, signal.SIGTERM]
+# Clients choose the protocol version they send, so the number of cached
+# status responses needs a bound.
+STATUS_CACHE_SIZE = 64
+
+
+class FakeServerLimits(NamedTuple):
+    handshake_timeout: float = DEFAULT_HANDSHAKE_TIMEOUT
+    idle_timeout: float = DEFAULT_IDLE_TIMEOUT
+    max_connections: int = DEFAULT_MAX_CONNECTIONS
+    # Connections per second allowed from an address, with bursts up to
+    # the burst size.
+    rate: float = DEFAULT_RATE
+    burst: int = DEFAULT_BURST
+
+
+class LogSampler:
+    def __init__(self) -> None:
+        self.counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+
+    def sample(self, key: Tuple[str, str]) -> int:
+        count = self.counts.pop(key, 0) + 1
+        self.counts[key] = count
+        if len(self.counts) > MAX_TRACKED_ADDRESSES:
+            self.counts.popitem(last=False)
+
+        # Log the 1st, 2nd, 4th, 8th... occurrence
+        return count if count & (count - 1) == 0 else 0
+
+
+class ConnectionLimiter:
+    def __init__(self, limits: FakeServerLimits) -> None:
+        self.limits = limits
+        self.active = 0
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.sampler = LogSampler()
+
+    def acquire(self, client_addr: str) -> Optional[str]:
+        if self.active >= self.limits.max_connections:
+            return f"over the limit of {self.limits.max_connections} connections"
+
+        if not self.take_token(client_addr):
+            return f"over the rate limit of {self.limits.rate}/s"
+
+        self.active += 1
+        return None
+
+    def release(self) -> None:
+        self.active -= 1
+
+    def take_token(self, client_addr: str) -> bool:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(client_addr, (self.limits.burst, now))
+        tokens = min(self.limits.burst, tokens + (now - updated) * self.limits.rate)
+        allowed = tokens >= 1
+        self.buckets[client_addr] = (tokens - 1 if allowed else tokens, now)
+        # Addresses evicted here have not connected in a while, so they
+        # would have a full bucket anyway.
+        if len(self.buckets) > MAX_TRACKED_ADDRESSES:
+            self.buckets.popitem(last=False)
+
+        return allowed
+
+    def log(
+        self, level: int, client_addr: str, kind: str, msg: str, *args: Any
+    ) -> None:
+        count = self.sampler.sample((client_addr, kind))
+        if count > 1:
+            LOG.log(level, f"{msg} (%d times)", *args, count)
+        elif count:
+            LOG.log(level, msg, *args)
+
+
+class FakeResponses:
+    def __init__(
+        self, ping_response: Dict[str, Any], login_response: Dict[str, Any]
+    ) -> None:
+        self.ping_response = ping_response
+        self.login = pack_json_packet(0, login_response)
+        self.status = functools.lru_cache(maxsize=STATUS_CACHE_SIZE)(self.pack_status)
+        motd = ping_response["description"]["text"]
+        players = ping_response["players"]
+        version = ping_response["version"]["name"]
+        self.legacy = pack_legacy_kick(
+            "\u00a71\0"
+            + "\0".join(
+                str(field)
+                for field in [
+                    LEGACY_PROTOCOL,
+                    version,
+                    motd,
+                    players["online"],
+                    players["max"],
+                ]
+            )
+        )
+        # Clients before 1.4 do not support color codes in the MOTD either
+        self.legacy_beta = pack_legacy_kick(
+            f"{motd}\u00a7{players['online']}\u00a7{players['max']}"
+        )
 
-
-class ProtocolError(MctlError):
-    pass
+    def pack_status(self, protocol: int) -> bytes:
+        version = dict(self.ping_response["version"], protocol=protocol)
+        return pack_json_packet(0, dict(self.ping_response, version=version))
 
 
-async def pack_and_send(
-    writer: asyncio.StreamWriter, packet_id: int, *args: bytes
+async def handle_legacy_ping(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    responses: FakeResponses,
+    limiter: ConnectionLimiter,
 ) -> None:
-    data = pack_varint(packet_id)
-    for arg in args:
-        data += arg
-
-    data = pack_varint(len(data)) + data
-    writer.write(data)
-
-
-def pack_varint(value: int) -> bytes:
-    if value == 0:
-        return b"\x00"
-
-    data: List[int] = []
-    while value != 0:
-        byte = value & 0x7F
-        # Logical right shift
-        value = (value % (1 << 32)) >> 7
-        if value != 0:
-            byte |= 0x80
-
-        data.append(byte)
-
-    return bytes(data)
-
-
-def pack_str(value: str) -> bytes:
-    data = value.encode("utf-8")
-    return pack_varint(len(data)) + data
-
-
-async def read_varint(reader: asyncio.StreamReader) -> int:
-    value = 0
-    byte = 0x80
-    bytes_read = 0
-    while (byte & 0x80) != 0:
-        data = await reader.read(1)
-        if not data or len(data) != 1:
-            raise ProtocolError("Failed first varint byte")
-
-        byte = data[0]
-        value |= (byte & 0x7F) << (bytes_read * 7)
-        bytes_read += 1
-        if bytes_read > 5:
-            raise ProtocolError("Malformed varint")
-
-    return value
-
-
-def unpack_short(data: bytes) -> Tuple[bytes, int]:
-    if len(data) < 2:
-        raise ProtocolError("Failed to read short value")
-
-    value = (data[0] << 8) | data[1]
-    return data[2:], value
-
-
-def unpack_str(data: bytes) -> Tuple[bytes, str]:
-    data, length = unpack_varint(data)
-    if len(data) < length:
-        raise ProtocolError("String too long for packet")
-
-    value = data[:length].decode("utf-8")
-    return data[length:], value
-
-
-def unpack_varint(data: bytes) -> Tuple[bytes, int]:
-    value = 0
-    byte = 0x80
-    bytes_read = 0
-    while (byte & 0x80) != 0:
-        if len(data) < 1:
-            raise ProtocolError("Failed first varint bytte")
-
-        byte = data[0]
-        data = data[1:]
-        value |= (byte & 0x7F) << (bytes_read * 7)
-        bytes_read += 1
-        if bytes_read > 5:
-            raise ProtocolError("Malformed varint")
-
-    # At or over bit 31 (sign bit) means it's a negative number
-    if value >= 1 << 31:
-        value -= 1 << 32
-
-    return data, value
+    client_addr, _ = writer.get_extra_info("peername")
+    # Clients from 1.4 onward follow 0xFE with 0x01, anything older sends
+    # nothing else.
+    try:
+        data = await asyncio.wait_for(reader.read(1), LEGACY_PING_TIMEOUT)
+    except asyncio.TimeoutError:
+        data = b""
 
+    if data == b"\x01":
+        writer.write(responses.legacy)
+    else:
+        writer.write(responses.legacy_beta)
 
-async def handle_packet(reader: asyncio.StreamReader) -> Tuple[bytes, int]:
-    length = await read_varint(reader)
-    # Comparison against an arbitrary number to avoid a memory DoS
-    if length > 2048:
-        raise ProtocolError("Packet too large")
+    limiter.log(
+        logging.INFO,
+        client_addr,
+        "legacy",
+        "Client %s pinged using the legacy protocol",
+        client_addr,
+    )
 
-    packet_data = await reader.read(length)
-    if length < 1 or len(packet_data) != length:
-        raise ProtocolError("Failed to read all packet data")
 
-    return unpack_varint(packet_data)
+async def handle_status(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    responses: FakeResponses,
+    client_version: int,
+    idle_timeout: float,
+) -> None:
+    # The client requests the status and then pings to measure the latency,
+    # the connection is done once the pong is sent. Clients which do not
+    # care about the latency close the connection after the status instead.
+    # The status is only sent once, so a single handshake cannot be used to
+    # pull any number of them past the rate limit.
+    status_sent = False
+    while True:
+        first_byte = await asyncio.wait_for(reader.read(1), idle_timeout)
+        if not first_byte:
+            return
+
+        packet_id, packet = await asyncio.wait_for(
+            read_packet(reader, MAX_PACKET_LENGTH, first_byte[0]), idle_timeout
+        )
+        if packet_id == 0 and not status_sent:
+            writer.write(responses.status(client_version))
+            status_sent = True
+        elif packet_id == 1:
+            pong = PacketWriter(1)
+            pong.write_long(packet.read_long())
+            writer.write(pong.finish())
+            return
+        else:
+            raise ProtocolError(f"Unexpected status packet ID 0x{packet_id:02x}")
 
 
-async def handle_ping(
-    packet_data: bytes,
+async def handle_handshake(
+    packet: PacketReader,
+    reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
-    ping_response: Dict[str, Any],
-    login_response: Dict[str, Any],
+    responses: FakeResponses,
+    limiter: ConnectionLimiter,
+    wake: Optional[Callable[[], bytes]] = None,
 ) -> None:
     client_addr, _ = writer.get_extra_info("peername")
-    packet_data, client_version = unpack_varint(packet_data)
-    packet_data, with_addr = unpack_str(packet_data)
-    packet_data, with_port = unpack_short(packet_data)
-    packet_data, next_state = unpack_varint(packet_data)
+    client_version = packet.read_varint()
+    with_addr = packet.read_str()
+    with_port = packet.read_short()
+    next_state = packet.read_varint()
 
-    action = "tried an unknown action"
-    response: Dict[str, Any] = {}
     if next_state == 1:
         action = "pinged"
-        response = copy.deepcopy(ping_response)
-        response["version"]["protocol"] = client_version
     elif next_state == 2:
         action = "logged in"
-        response = login_response
     else:
         raise ProtocolError(f"Unsupported next state: {next_state}")
 
-    LOG.info(
+    limiter.log(
+        logging.INFO,
+        client_addr,
+        action,
         "Client %s %s via address %s on port %d using version %d",
         client_addr,
         action,
@@ -169,47 +257,119 @@ async def handle_ping(
         with_port,
         client_version,
     )
+    if next_state == 1:
+        await handle_status(
+            reader, writer, responses, client_version, limiter.limits.idle_timeout
+        )
+    elif wake is not None:
+        writer.write(wake())
+    else:
+        writer.write(responses.login)
+
+
+async def read_first_packet(
+    reader: asyncio.StreamReader,
+) -> Optional[Tuple[int, Optional[PacketReader]]]:
+    first_byte = await reader.read(1)
+    if not first_byte:
+        return None
+
+    if first_byte[0] == LEGACY_PING_ID:
+        return LEGACY_PING_ID, None
+
+    return await read_packet(reader, MAX_PACKET_LENGTH, first_byte[0])
 
-    # Explicitly avoid any sort of white-spacing in the JSON. The client cannot
-    # parse the JSON with any white-spacing outside of a JSON string.
-    response_json = json.dumps(response, indent=None, separators=(",", ":"))
-    await pack_and_send(writer, 0, pack_str(response_json))
-    writer.close()
+
+class FakeService:
+    def __init__(
+        self,
+        responses: FakeResponses,
+        limits: FakeServerLimits,
+        wake: Optional[Callable[[], bytes]] = None,
+    ) -> None:
+        self.responses = responses
+        self.limiter = ConnectionLimiter(limits)
+        self.wake = wake
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # Responses are swapped as a whole on reload, so a connection always
+        # sees a complete set of them.
+        await connection_handler(
+            reader, writer, self.responses, self.limiter, self.wake
+        )
+
+    async def reload(self, message: str, motd: str, icon_file: Optional[str]) -> None:
+        self.responses = await load_responses(message, motd, icon_file)
 
 
 async def connection_handler(
     reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
-    ping_response: Dict[str, Any],
-    login_response: Dict[str, Any],
+    responses: FakeResponses,
+    limiter: ConnectionLimiter,
+    wake: Optional[Callable[[], bytes]] = None,
 ) -> None:
     client_addr, _ = writer.get_extra_info("peername")
+    # Connections over the limits are closed right away, which keeps the
+    # number of open fds bounded no matter how fast a client connects.
+    reason = limiter.acquire(client_addr)
+    if reason is not None:
+        limiter.log(
+            logging.WARNING,
+            client_addr,
+            "rejected",
+            "Rejected connection from %s: %s",
+            client_addr,
+            reason,
+        )
+        writer.close()
+        return
+
     LOG.debug("New connection from %s", client_addr)
     try:
-        packet_data, packet_id = await handle_packet(reader)
-        if packet_id == 0:
-            await handle_ping(
-                packet_data,
-                writer=writer,
-                ping_response=ping_response,
-                login_response=login_response,
-            )
+        first = await asyncio.wait_for(
+            read_first_packet(reader), limiter.limits.handshake_timeout
+        )
+        if first is None:
+            LOG.debug("Client %s closed the connection without sending", client_addr)
+        elif first[0] == LEGACY_PING_ID:
+            await handle_legacy_ping(reader, writer, responses, limiter)
+        elif first[0] != 0 or first[1] is None:
+            raise ProtocolError(f"Unsupported packet ID 0x{first[0]:02x}")
         else:
-            raise ProtocolError(f"Unsupported packet ID 0x{packet_id:20x}")
-    except ProtocolError as ex:
-        LOG.error("Client %s requests errored: %s", client_addr, ex)
-
-    writer.close()
-
-
-async def run_fake_server(
-    listen_address: Optional[str] = None,
-    port: int = DEFAULT_PORT,
+            await handle_handshake(first[1], reader, writer, responses, limiter, wake)
+    except asyncio.TimeoutError:
+        limiter.log(
+            logging.INFO,
+            client_addr,
+            "timeout",
+            "Client %s timed out",
+            client_addr,
+        )
+    except (ConnectionError, ProtocolError) as ex:
+        limiter.log(
+            logging.ERROR,
+            client_addr,
+            "error",
+            "Client %s requests errored: %s",
+            client_addr,
+            ex,
+        )
+    finally:
+        limiter.release()
+        writer.close()
+
+
+async def load_responses(
     message: str = DEFAULT_MESSAGE,
     motd: str = DEFAULT_MOTD,
     icon_file: Optional[str] = None,
-) -> None:
+) -> FakeResponses:
     if icon_file is not None:
+        import aiofiles
+
         try:
             async with aiofiles.open(icon_file, "rb") as fp:
                 icon_png_bytes = await fp.read()
@@ -218,6 +378,8 @@ async def run_fake_server(
 
         icon_png_base64 = base64.b64encode(icon_png_bytes).decode("utf-8")
     else:
+        from mctl.favicons import CAUTION_BASE64
+
         icon_png_base64 = CAUTION_BASE64
 
     ping_response = {
@@ -228,20 +390,155 @@ async def run_fake_server(
             "online": 0,
             "sample": [],
         },
-        "version": {"name": "MCTL", "protocol": 0},
+        "version": {"name": FAKE_VERSION_NAME, "protocol": 0},
     }
     login_response = {
         "bold": True,
         "color": "red",
         "text": message,
     }
+    return FakeResponses(ping_response, login_response)
+
 
+async def run_fake_server(
+    listen_address: Optional[str] = None,
+    port: int = DEFAULT_PORT,
+    message: str = DEFAULT_MESSAGE,
+    motd: str = DEFAULT_MOTD,
+    icon_file: Optional[str] = None,
+    bind_timeout: float = 0,
+    limits: FakeServerLimits = FakeServerLimits(),
+) -> None:
+    service = FakeService(await load_responses(message, motd, icon_file), limits)
     LOG.info("Starting fake-server on %s, port %d", listen_address, port)
-    conn_cb = functools.partial(
-        connection_handler,
-        ping_response=ping_response,
-        login_response=login_response,
+    server = await start_server(
+        service.handle_connection, listen_address, port, bind_timeout
     )
-    server = await asyncio.start_server(conn_cb, listen_address, port)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in STOP_SIGNALS:
+        loop.add_signal_handler(sig, stopping.set)
+
+    async def reload() -> None:
+        try:
+            await service.reload(message, motd, icon_file)
+        except MctlError as ex:
+            LOG.error("Failed to reload fake-server: %s", ex)
+        else:
+            LOG.info("Reloaded fake-server on %s, port %d", listen_address, port)
+
+    # Reloading rereads the icon file without closing the listener
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload()))
+
     async with server:
-        await server.serve_forever()
+        await server.start_serving()
+        await stopping.wait()
+        # Release the port right away for the server taking over
+        LOG.info("Stopping fake-server on %s, port %d", listen_address, port)
+        server.close()
+
+
+async def start_server(
+    conn_cb: Callable,
+    listen_address: Optional[str],
+    port: int,
+    bind_timeout: float = 0,
+) -> asyncio.AbstractServer:
+    # SO_REUSEPORT allows binding while the previous listener is still
+    # closing, it is not supported everywhere though.
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    deadline = time.monotonic() + bind_timeout
+    while True:
+        try:
+            return await asyncio.start_server(
+                conn_cb,
+                listen_address,
+                port,
+                reuse_port=reuse_port,
+                start_serving=False,
+            )
+        except OSError as ex:
+            if ex.errno != errno.EADDRINUSE or time.monotonic() >= deadline:
+                raise MctlError(f"Failed to listen on port {port}: {ex}")
+
+        LOG.debug("Port %d still in use, retrying", port)
+        await asyncio.sleep(BIND_RETRY_INTERVAL)
+
+
+def start_worker(main: Callable[[], Awaitable[None]], number: int) -> int:
+    pid = os.fork()
+    if pid != 0:
+        LOG.debug("Started fake-server worker %d with PID %d", number, pid)
+        return pid
+
+    # The worker sets up its own signal handling on its event loop
+    for sig in STOP_SIGNALS + [signal.SIGHUP]:
+        signal.signal(sig, signal.SIG_DFL)
+
+    code = 0
+    try:
+        run_event_loop(main())
+    except MctlError as ex:
+        LOG.error("Fake-server worker %d failed: %s", number, ex)
+        code = 1
+    except BaseException:
+        LOG.exception("Fake-server worker %d failed", number)
+        code = 1
+
+    os._exit(code)
+
+
+def run_fake_server_workers(workers: int, main: Callable[[], Awaitable[None]]) -> None:
+    # Every worker listens on the same port and the kernel balances new
+    # connections between them.
+    massert(hasattr(socket, "SO_REUSEPORT"), "Fake-server workers require SO_REUSEPORT")
+    children: Dict[int, Tuple[int, float]] = {}
+    stopping = False
+
+    def stop(sig: int, frame: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(sig: int, frame: Any) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    for sig in STOP_SIGNALS:
+        signal.signal(sig, stop)
+
+    signal.signal(signal.SIGHUP, reload)
+
+    LOG.info("Starting %d fake-server workers", workers)
+    for number in range(workers):
+        children[start_worker(main, number)] = (number, time.monotonic())
+
+    while children:
+        pid, status = os.wait()
+        if pid not in children:
+            continue
+
+        number, started = children.pop(pid)
+        if stopping:
+            continue
+
+        LOG.warning(
+            "Fake-server worker %d (PID %d) exited with status %d, restarting",
+            number,
+            pid,
+            status,
+        )
+        if time.monotonic() - started < WORKER_MIN_UPTIME:
+            time.sleep(WORKER_RESTART_DELAY)
+
+        if not stopping:
+            children[start_worker(main, number)] = (number, time.monotonic())
+
+    LOG.info("Stopped all fake-server workers")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import logging
+import time
+from typing import Dict, List
+
+from mctl.config import Config, Server
+from mctl.exception import massert, MctlError
+from mctl.ping import DEFAULT_PING_TIMEOUT
+from mctl.server import (
+    ActiveSessions,
+    get_all_active_sessions,
+    server_status,
+    server_stop,
+)
+
+DEFAULT_IDLE_INTERVAL = 60.0
+LOG = logging.getLogger(__name__)
+
+
+class IdleWatcher:
+    def __init__(self, servers: List[Server]) -> None:
+        self.servers = servers
+        # When each server was first seen running and first seen empty
+        self.running_since: Dict[str, float] = {}
+        self.idle_since: Dict[str, float] = {}
+        self.stopping: Dict[str, "asyncio.Future[None]"] = {}
+
+    async def check_server(
+        self, server: Server, active_sessions: ActiveSessions, now: float
+    ) -> None:
+        if not active_sessions.main or active_sessions.fake:
+            self.running_since.pop(server.name, None)
+            self.idle_since.pop(server.name, None)
+            return
+
+        running_since = self.running_since.setdefault(server.name, now)
+        status = await server_status(server, active_sessions, DEFAULT_PING_TIMEOUT)
+        # A server which cannot be pinged may still be starting up, only
+        # servers reporting no players count as idle.
+        if not status.ping.online or status.ping.players_online != 0:
+            self.idle_since.pop(server.name, None)
+            return
+
+        idle_since = self.idle_since.setdefault(server.name, now)
+        if now - idle_since < server.idle_timeout:
+            return
+
+        # The cooldown keeps a server woken up by a player from being stopped
+        # again right away when that player is slow to rejoin.
+        if now - running_since < server.idle_cooldown:
+            LOG.debug("Server %s idle but still cooling down", server.name)
+            return
+
+        LOG.info("Server %s idle for %.0fs, stopping it", server.name, now - idle_since)
+        self.running_since.pop(server.name)
+        self.idle_since.pop(server.name)
+        self.stopping[server.name] = asyncio.ensure_future(self.stop_server(server))
+
+    async def stop_server(self, server: Server) -> None:
+        try:
+            await server_stop(server, server.idle_message, False, True)
+        except MctlError as ex:
+            LOG.error("Failed to stop idle server %s: %s", server.name, ex)
+        finally:
+            self.stopping.pop(server.name, None)
+
+    async def check(self) -> None:
+        # A single pass over every server, sharing one screen listing
+        all_sessions = await get_all_active_sessions(self.servers)
+        now = time.monotonic()
+        await asyncio.gather(
+            *[
+                self.check_server(server, all_sessions[server.name], now)
+                for server in self.servers
+                if server.name not in self.stopping
+            ]
+        )
+
+    async def run(self, interval: float, iterations: int = 0) -> None:
+        iteration = 0
+        while iterations <= 0 or iteration < iterations:
+            try:
+                await self.check()
+            except MctlError as ex:
+                LOG.error("Failed to check for idle servers: %s", ex)
+
+            iteration += 1
+            if iterations <= 0 or iteration < iterations:
+                await asyncio.sleep(interval)
+
+        if self.stopping:
+            await asyncio.gather(*self.stopping.values())
+
+
+async def run_idle_watcher(
+    config: Config,
+    interval: float = DEFAULT_IDLE_INTERVAL,
+    iterations: int = 0,
+) -> None:
+    servers = [server for server in config.servers.values() if server.idle_timeout > 0]
+    massert(servers, "No servers with an idle timeout to watch")
+    LOG.info(
+        "Watching %s for idle servers every %.0fs",
+        ", ".join(server.name for server in servers),
+        interval,
+    )
+    await IdleWatcher(servers).run(interval, iterations)
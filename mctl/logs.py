@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import ctypes
+import ctypes.util
+from enum import Enum
+import functools
+import gzip
+import logging
+import os
+import re
+import time
+from typing import (
+    AsyncIterator,
+    BinaryIO,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from mctl.config import Server
+from mctl.exception import MctlError
+
+BLOCK_SIZE = 64 * 1024
+# IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_MASK = 0x002 | 0x040 | 0x080 | 0x100 | 0x200
+LOG = logging.getLogger(__name__)
+POLL_INTERVAL = 0.25
+READ_SIZE = 1024 * 1024
+# Number of recent startups used to estimate how long a server takes to start
+STARTUP_HISTORY = 5
+# Safety net for changes inotify cannot report, like the watched directory
+# being created after the watch was attempted.
+WATCH_TIMEOUT = 5
+
+
+class LogEventType(Enum):
+    READY = "ready"
+    SAVED = "saved"
+    STOPPING = "stopping"
+    CRASHED = "crashed"
+
+
+class LogEvent(NamedTuple):
+    type: LogEventType
+    line: str
+    # Startup time reported by the server for READY events
+    seconds: Optional[float] = None
+
+
+LOG_EVENT_PATTERNS = [
+    (LogEventType.READY, re.compile(r"Done \((?P<seconds>[0-9.,]+)s\)!")),
+    (LogEventType.SAVED, re.compile(r"Saved the (game|world)")),
+    (LogEventType.STOPPING, re.compile(r"Stopping (the )?server")),
+    (
+        LogEventType.CRASHED,
+        re.compile(
+            r"(This crash report has been saved to|"
+            r"Encountered an unexpected exception|"
+            r"Failed to start the minecraft server|"
+            r"FAILED TO BIND TO PORT)"
+        ),
+    ),
+]
+
+
+def get_log_path(server: Server) -> str:
+    return os.path.join(server.path, "logs", "latest.log")
+
+
+def parse_log_event(line: str) -> Optional[LogEvent]:
+    for event_type, pattern in LOG_EVENT_PATTERNS:
+        match = pattern.search(line)
+        if not match:
+            continue
+
+        seconds = None
+        if event_type == LogEventType.READY:
+            seconds = float(match.group("seconds").replace(",", "."))
+
+        return LogEvent(type=event_type, line=line, seconds=seconds)
+
+    return None
+
+
+def get_startup_history(server: Server, limit: int = STARTUP_HISTORY) -> List[float]:
+    log_dir = os.path.dirname(get_log_path(server))
+    try:
+        names = os.listdir(log_dir)
+    except FileNotFoundError:
+        return []
+
+    # Rotated logs are gzipped, the newest of them are searched first. Logs
+    # may be rotated away while listing them.
+    mtimes: List[Tuple[float, str]] = []
+    for name in names:
+        if name != "latest.log" and not name.endswith(".log.gz"):
+            continue
+
+        path = os.path.join(log_dir, name)
+        try:
+            mtimes.append((os.path.getmtime(path), path))
+        except OSError as ex:
+            LOG.debug("Failed to stat log %s: %s", path, ex)
+
+    history: List[float] = []
+    for _, path in sorted(mtimes, reverse=True):
+        seconds = []
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rt", errors="replace") as fp:
+                for line in fp:
+                    event = parse_log_event(line) if "Done (" in line else None
+                    if event is not None and event.seconds is not None:
+                        seconds.append(event.seconds)
+        except (OSError, EOFError) as ex:
+            LOG.debug("Failed to read startup times from %s: %s", path, ex)
+            continue
+
+        history.extend(reversed(seconds))
+        if len(history) >= limit:
+            break
+
+    return history[:limit]
+
+
+class LogTailer:
+    def __init__(self, path: str, from_end: bool = True) -> None:
+        self.path = path
+        self.from_end = from_end
+        self.fp: Optional[BinaryIO] = None
+        self.inode: Optional[int] = None
+        self.partial = b""
+
+    def __enter__(self) -> "LogTailer":
+        self.open(self.from_end)
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def open(self, from_end: bool) -> None:
+        self.close()
+        try:
+            self.fp = open(self.path, "rb")
+        except FileNotFoundError:
+            LOG.debug("Log file %s does not exist yet", self.path)
+            return
+
+        st = os.fstat(self.fp.fileno())
+        self.inode = st.st_ino
+        if from_end:
+            self.fp.seek(0, os.SEEK_END)
+
+        LOG.debug("Tailing %s from offset %d", self.path, self.fp.tell())
+
+    def close(self) -> None:
+        if self.fp is not None:
+            self.fp.close()
+
+        self.fp = None
+        self.inode = None
+        self.partial = b""
+
+    def rotated(self) -> bool:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+
+        if self.fp is None:
+            return True
+
+        # The server rotates latest.log on startup by moving it away and
+        # creating a new file, but handle truncation just in case.
+        return st.st_ino != self.inode or st.st_size < self.fp.tell()
+
+    def read_data(self) -> bytes:
+        if self.fp is None:
+            return b""
+
+        data = self.fp.read(READ_SIZE)
+        if not data:
+            return b""
+
+        data = self.partial + data
+        *lines, self.partial = data.split(b"\n")
+        return b"\n".join(lines + [b""]) if lines else b""
+
+    def read_lines(self) -> List[str]:
+        data = self.read_data()
+        if not data and self.rotated():
+            LOG.debug("Log file %s rotated, reopening", self.path)
+            self.open(False)
+            data = self.read_data()
+
+        return [
+            line.decode("utf-8", "replace").rstrip("\r")
+            for line in data.split(b"\n")[:-1]
+        ]
+
+    async def lines(self) -> AsyncIterator[str]:
+        watcher: Optional[DirectoryWatcher] = None
+        try:
+            while True:
+                lines = self.read_lines()
+                for line in lines:
+                    yield line
+
+                if lines:
+                    continue
+
+                if watcher is None:
+                    watcher = DirectoryWatcher.create(os.path.dirname(self.path))
+
+                if watcher is not None:
+                    await watcher.wait(WATCH_TIMEOUT)
+                else:
+                    await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def offset(self) -> int:
+        return self.fp.tell() if self.fp is not None else 0
+
+
+class DirectoryWatcher:
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.changed = asyncio.Event()
+        asyncio.get_running_loop().add_reader(fd, self.on_readable)
+
+    @staticmethod
+    def create(path: str) -> Optional["DirectoryWatcher"]:
+        libc = get_libc()
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            return None
+
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            LOG.debug("Failed to create inotify instance: %s", ctypes.get_errno())
+            return None
+
+        # Watching the directory catches writes to the file along with the
+        # file being moved away, deleted or created during log rotation.
+        if libc.inotify_add_watch(fd, path.encode("utf-8"), INOTIFY_MASK) < 0:
+            LOG.debug("Failed to watch %s: %s", path, ctypes.get_errno())
+            os.close(fd)
+            return None
+
+        return DirectoryWatcher(fd)
+
+    def close(self) -> None:
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+    def on_readable(self) -> None:
+        # Only the fact something changed matters, not the events themselves
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        self.changed.set()
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        self.changed.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_libc() -> Optional[ctypes.CDLL]:
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+
+
+def read_lines_reverse(path: str, end: Optional[int] = None) -> Iterator[str]:
+    with open(path, "rb") as fp:
+        pos = fp.seek(0, os.SEEK_END) if end is None else end
+        remainder = b""
+        at_end = True
+        while pos > 0:
+            size = min(BLOCK_SIZE, pos)
+            pos -= size
+            fp.seek(pos)
+            lines = (fp.read(size) + remainder).split(b"\n")
+            remainder = lines.pop(0)
+            if at_end and lines and not lines[-1]:
+                lines.pop()
+
+            at_end = False
+            for line in reversed(lines):
+                yield line.decode("utf-8", "replace").rstrip("\r")
+
+        if remainder:
+            yield remainder.decode("utf-8", "replace").rstrip("\r")
+
+
+def tail_lines(
+    path: str,
+    count: int,
+    pattern: Optional[re.Pattern] = None,
+    end: Optional[int] = None,
+) -> List[str]:
+    lines: List[str] = []
+    if count <= 0:
+        return lines
+
+    try:
+        for line in read_lines_reverse(path, end):
+            if pattern is None or pattern.search(line):
+                lines.append(line)
+                if len(lines) >= count:
+                    break
+    except FileNotFoundError:
+        LOG.debug("Log file %s does not exist", path)
+
+    lines.reverse()
+    return lines
+
+
+async def wait_for_log_event(
+    tailer: LogTailer, event_types: Iterable[LogEventType], timeout: float
+) -> LogEvent:
+    event_types = set(event_types)
+
+    async def wait() -> LogEvent:
+        async for line in tailer.lines():
+            event = parse_log_event(line)
+            if event and event.type in event_types:
+                return event
+
+        raise MctlError(f"Log file {tailer.path} ended unexpectedly")
+
+    start = time.monotonic()
+    try:
+        event = await asyncio.wait_for(wait(), timeout)
+    except asyncio.TimeoutError:
+        types = ", ".join(sorted(event_type.value for event_type in event_types))
+        raise MctlError(
+            f"Timed out after {timeout}s waiting for {types} in {tailer.path}"
+        )
+
+    LOG.debug(
+        "Got %s log event after %.3fs: %s",
+        event.type.value,
+        time.monotonic() - start,
+        event.line,
+    )
+    return event
+
+
+async def follow_log(
+    tailer: LogTailer, pattern: Optional[re.Pattern] = None
+) -> AsyncIterator[str]:
+    async for line in tailer.lines():
+        if pattern is None or pattern.search(line):
+            yield line
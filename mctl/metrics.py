@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from collections import defaultdict
+import logging
+import os
+import time
+from typing import DefaultDict, Dict, List, Optional, Tuple
+
+from mctl.config import Config
+from mctl.fake_host import get_fake_host_servers
+from mctl.package import package_revisions, sort_revisions_n2o
+from mctl.process import get_process_children, read_process_stats
+from mctl.server import (
+    get_screen_output,
+    parse_active_sessions,
+    parse_session_pids,
+    server_status,
+)
+
+DEFAULT_METRICS_PORT = 9567
+DEFAULT_METRICS_TTL = 10.0
+LOG = logging.getLogger(__name__)
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRIC_INFO = {
+    "mctl_server_running": ("gauge", "Whether the server screen session exists"),
+    "mctl_server_fake": ("gauge", "Whether the fake server is running"),
+    "mctl_server_up": ("gauge", "Whether the server responds to pings"),
+    "mctl_server_players_online": ("gauge", "Number of players online"),
+    "mctl_server_players_max": ("gauge", "Maximum number of players"),
+    "mctl_server_ping_latency_seconds": ("gauge", "Server List Ping latency"),
+    "mctl_server_memory_rss_bytes": ("gauge", "Resident memory of the server"),
+    "mctl_server_cpu_seconds_total": ("counter", "CPU time used by the server"),
+    "mctl_server_threads": ("gauge", "Number of threads of the server"),
+    "mctl_package_revisions": ("gauge", "Number of archived package revisions"),
+    "mctl_package_latest_revision_age_seconds": (
+        "gauge",
+        "Age of the latest built package revision",
+    ),
+    "mctl_package_archive_bytes": ("gauge", "Disk usage of archived revisions"),
+    "mctl_scrape_duration_seconds": ("gauge", "Time taken to collect metrics"),
+}
+
+Samples = DefaultDict[str, List[Tuple[Dict[str, str], float]]]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_metrics(samples: Samples) -> str:
+    lines = []
+    for name, values in samples.items():
+        metric_type, help_text = METRIC_INFO[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in values:
+            label_str = ",".join(
+                f'{key}="{escape_label_value(val)}"' for key, val in labels.items()
+            )
+            if label_str:
+                label_str = f"{{{label_str}}}"
+
+            lines.append(f"{name}{label_str} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_dir_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+def collect_package_metrics(config: Config, samples: Samples) -> None:
+    for package in config.packages.values():
+        labels = {"package": package.name}
+        revs = package_revisions(config, package)
+        samples["mctl_package_revisions"].append((labels, len(revs)))
+        if revs:
+            _, latest_time = sort_revisions_n2o(revs)[0]
+            samples["mctl_package_latest_revision_age_seconds"].append(
+                (labels, time.time() - latest_time)
+            )
+
+        archive_dir = os.path.join(config.data_path, "archive", package.name)
+        samples["mctl_package_archive_bytes"].append(
+            (labels, get_dir_size(archive_dir))
+        )
+
+
+async def collect_metrics(config: Config, ping_timeout: float) -> Samples:
+    start = time.monotonic()
+    samples: Samples = defaultdict(list)
+    servers = list(config.servers.values())
+    screen_output = await get_screen_output()
+    fake_servers = await get_fake_host_servers()
+    children = get_process_children()
+    all_sessions = {
+        server.name: parse_active_sessions(server, screen_output, fake_servers)
+        for server in servers
+    }
+    statuses = await asyncio.gather(
+        *[
+            server_status(server, all_sessions[server.name], ping_timeout)
+            for server in servers
+        ]
+    )
+
+    for server, status in zip(servers, statuses):
+        labels = {"server": server.name}
+        sessions = all_sessions[server.name]
+        samples["mctl_server_running"].append((labels, int(sessions.main)))
+        samples["mctl_server_fake"].append((labels, int(sessions.fake)))
+        samples["mctl_server_up"].append((labels, int(status.ping.online)))
+        if status.ping.online:
+            if status.ping.players_online is not None:
+                samples["mctl_server_players_online"].append(
+                    (labels, status.ping.players_online)
+                )
+
+            if status.ping.players_max is not None:
+                samples["mctl_server_players_max"].append(
+                    (labels, status.ping.players_max)
+                )
+
+            if status.ping.latency is not None:
+                samples["mctl_server_ping_latency_seconds"].append(
+                    (labels, status.ping.latency / 1000)
+                )
+
+        pids = parse_session_pids(server, screen_output, children=children)
+        stats = read_process_stats(pids.server) if pids.server else None
+        if stats is not None:
+            samples["mctl_server_memory_rss_bytes"].append((labels, stats.rss_bytes))
+            samples["mctl_server_cpu_seconds_total"].append((labels, stats.cpu_seconds))
+            samples["mctl_server_threads"].append((labels, stats.threads))
+
+    # Walking the archive may touch a lot of files, keep it off the loop
+    await asyncio.get_running_loop().run_in_executor(
+        None, collect_package_metrics, config, samples
+    )
+
+    samples["mctl_scrape_duration_seconds"].append(({}, time.monotonic() - start))
+    return samples
+
+
+class MetricsCache:
+    def __init__(self, config: Config, ttl: float, ping_timeout: float) -> None:
+        self.config = config
+        self.ttl = ttl
+        self.ping_timeout = ping_timeout
+        self.lock = asyncio.Lock()
+        self.text = ""
+        self.updated: Optional[float] = None
+
+    async def get(self) -> str:
+        # Concurrent scrapes wait on the same collection rather than each
+        # pinging every server.
+        async with self.lock:
+            now = time.monotonic()
+            if self.updated is None or now - self.updated >= self.ttl:
+                samples = await collect_metrics(self.config, self.ping_timeout)
+                self.text = format_metrics(samples)
+                self.updated = time.monotonic()
+
+        return self.text
+
+
+async def run_metrics_server(
+    config: Config,
+    listen_address: Optional[str],
+    port: int = DEFAULT_METRICS_PORT,
+    ttl: float = DEFAULT_METRICS_TTL,
+    ping_timeout: float = DEFAULT_METRICS_TTL / 2,
+) -> None:
+    from aiohttp import web
+
+    cache = MetricsCache(config, ttl, ping_timeout)
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        text = await cache.get()
+        return web.Response(
+            body=text.encode("utf-8"), headers={"Content-Type": METRICS_CONTENT_TYPE}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, listen_address, port)
+    LOG.info("Serving metrics on %s, port %d", listen_address, port)
+    await site.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
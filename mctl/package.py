@@ -17,11 +17,13 @@ from collections import defaultdict
 import logging
 import os
 import re
+import shutil
 import time
 from typing import DefaultDict, Dict, List, Optional, Tuple
 
 from mctl.config import Config, Package, Server
 from mctl.exception import massert
+from mctl.profiling import span, spanned
 from mctl.repository import unified_repo_revision, update_all_repos
 from mctl.util import download_url, execute_shell_check, get_rel_dir_files
 
@@ -53,6 +55,19 @@ def archive_build(config: Config, package: Package, build_dir: str, rev: str) ->
         os.rename(artifact_path, archive_path)
 
 
+def server_artifact_paths(
+    config: Config, artifact_path: str
+) -> List[Tuple[Server, str]]:
+    # Revisions linked from the previous generation are kept for rollbacks
+    paths = []
+    for server in config.servers.values():
+        gens_dir = get_generations_dir(config, server)
+        paths.append((server, os.path.join(server.path, artifact_path)))
+        paths.append((server, os.path.join(gens_dir, "previous", artifact_path)))
+
+    return paths
+
+
 def cleanup_builds(config: Config, package: Package) -> None:
     revs = package_revisions(config, package)
     LOG.debug("Package %s has %d revisions", package.name, len(revs))
@@ -63,13 +78,14 @@ def cleanup_builds(config: Config, package: Package) -> None:
 
         in_use = False
         for artifact_path, (archive_path, _) in revs[rev].items():
-            for server in config.servers.values():
-                full_path = os.path.join(server.path, artifact_path)
+            for server, full_path in server_artifact_paths(config, artifact_path):
                 if not os.path.islink(full_path):
                     continue
 
-                link_path = os.readlink(full_path)
-                if os.path.samefile(link_path, archive_path):
+                link_path = os.path.realpath(full_path)
+                if os.path.exists(link_path) and os.path.samefile(
+                    link_path, archive_path
+                ):
                     LOG.debug(
                         "Revision %s for package %s still in use by server %s",
                         rev,
@@ -115,14 +131,18 @@ def cleanup_builds(config: Config, package: Package) -> None:
         )
 
 
+@spanned("build package {package.name}")
 async def package_build(config: Config, package: Package, force: bool = False) -> None:
     LOG.info("Building package %s", package.name)
     build_dir = os.path.join(config.data_path, "builds", package.name)
     os.makedirs(build_dir, exist_ok=True)
     repos = package.repositories.values()
-    await update_all_repos(build_dir, repos)
+    with span("update repositories"):
+        await update_all_repos(build_dir, repos)
+
+    with span("get revision"):
+        rev = await unified_repo_revision(build_dir, repos)
 
-    rev = await unified_repo_revision(build_dir, repos)
     prev_revs = package_revisions(config, package)
     if not force and rev is not None and rev in prev_revs:
         LOG.info(
@@ -136,17 +156,19 @@ async def package_build(config: Config, package: Package, force: bool = False) -
         LOG.info(
             "Fetching %d URLs for package %s...", len(package.fetch_urls), package.name
         )
-        await asyncio.gather(
-            *[
-                download_url(url, os.path.join(build_dir, path))
-                for path, url in package.fetch_urls.items()
-            ]
-        )
+        with span("fetch URLs"):
+            await asyncio.gather(
+                *[
+                    download_url(url, os.path.join(build_dir, path))
+                    for path, url in package.fetch_urls.items()
+                ]
+            )
 
     cmd_count = len(package.build_commands)
     for i, command in enumerate(package.build_commands, 1):
         LOG.info("Executing build command %d of %d: %s", i, cmd_count, command)
-        await execute_shell_check(command, hide_ouput=False, cwd=build_dir)
+        with span(f"build command {i} of {cmd_count}"):
+            await execute_shell_check(command, hide_ouput=False, cwd=build_dir)
 
     # Attempt to get an updated revision from all git repos after all
     # build commands have executed. This helps support packages that use
@@ -154,13 +176,18 @@ async def package_build(config: Config, package: Package, force: bool = False) -
     # process will update these repos twice. Once up above to make sure
     # the same revision is not being rebuilt. And once here to make sure
     # the revision is accurate.
-    rev = await unified_repo_revision(build_dir, repos)
+    with span("get revision"):
+        rev = await unified_repo_revision(build_dir, repos)
+
     if rev is None:
         rev = str(int(time.time()))
 
     # Cleanup before archiving to avoid cleaning up the new version
-    cleanup_builds(config, package)
-    archive_build(config, package, build_dir, rev)
+    with span("clean up builds"):
+        cleanup_builds(config, package)
+
+    with span("archive build", rev=rev):
+        archive_build(config, package, build_dir, rev)
 
 
 def package_revisions(
@@ -210,65 +237,211 @@ def package_revisions(
     return ret_revs
 
 
-async def package_upgrade(
+def get_current_revision(
+    server: Server, revs: Dict[str, Dict[str, Tuple[str, int]]]
+) -> Optional[str]:
+    rand_revs = list(revs.values())
+    if not rand_revs:
+        return None
+
+    rand_artifact = list(rand_revs[0])[0]
+    rand_path = os.path.join(server.path, rand_artifact)
+    if not os.path.islink(rand_path):
+        return None
+
+    # Artifacts link into the current generation, which links to the archive
+    root, ext = os.path.splitext(os.path.basename(rand_artifact))
+    match = re.match(
+        rf"{re.escape(root)}\-(?P<rev>[a-zA-Z0-9]+){re.escape(ext)}$",
+        os.path.basename(os.path.realpath(rand_path)),
+    )
+    return match.group("rev") if match else None
+
+
+def get_generations_dir(config: Config, server: Server) -> str:
+    return os.path.join(config.data_path, "generations", server.name)
+
+
+def read_generation(gen_dir: str) -> Dict[str, str]:
+    # {<relative_artifact_path>: <absolute_archive_path>}
+    if not os.path.isdir(gen_dir):
+        return {}
+
+    return {
+        path: os.readlink(os.path.join(gen_dir, path))
+        for path in get_rel_dir_files(gen_dir)
+        if os.path.islink(os.path.join(gen_dir, path))
+    }
+
+
+def replace_symlink(target: str, link_path: str) -> None:
+    os.makedirs(os.path.dirname(link_path), exist_ok=True)
+    tmp_path = f"{link_path}.mctl-tmp"
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, link_path)
+
+
+def link_generation(config: Config, server: Server, artifacts: Dict[str, str]) -> None:
+    current_dir = os.path.join(get_generations_dir(config, server), "current")
+    for path in artifacts:
+        artifact_path = os.path.join(server.path, path)
+        target = os.path.join(current_dir, path)
+        if os.path.islink(artifact_path) and os.readlink(artifact_path) == target:
+            continue
+
+        LOG.debug("Linking artifact %s to generation path %s", artifact_path, target)
+        replace_symlink(target, artifact_path)
+
+    # Remove links to artifacts that are not part of the current generation,
+    # which happens when rolling back from a generation that added a package.
+    for package_name in server.packages:
+        for path in config.get_package(package_name).artifacts:
+            artifact_path = os.path.join(server.path, path)
+            if path in artifacts or not os.path.islink(artifact_path):
+                continue
+
+            if os.readlink(artifact_path) == os.path.join(current_dir, path):
+                LOG.debug("Removing artifact %s not in generation", artifact_path)
+                os.unlink(artifact_path)
+
+
+def switch_generation(gens_dir: str, current: str, previous: Optional[str]) -> None:
+    if previous is not None:
+        replace_symlink(previous, os.path.join(gens_dir, "previous"))
+
+    # The switch to the new generation is this single rename
+    replace_symlink(current, os.path.join(gens_dir, "current"))
+
+
+def prune_generations(gens_dir: str) -> None:
+    in_use = {
+        os.readlink(os.path.join(gens_dir, name))
+        for name in ["current", "previous"]
+        if os.path.islink(os.path.join(gens_dir, name))
+    }
+    for name in os.listdir(gens_dir):
+        path = os.path.join(gens_dir, name)
+        if name in in_use or os.path.islink(path) or not os.path.isdir(path):
+            continue
+
+        LOG.debug("Removing old generation %s", path)
+        shutil.rmtree(path)
+
+
+def packages_upgrade(
     config: Config,
     server: Server,
-    package: Package,
+    packages: List[Package],
     rev: Optional[str] = None,
     force: bool = False,
 ) -> None:
-    massert(
-        package.name in server.packages,
-        f"Package {package.name} not used by server {server.name}",
-    )
-    revs = package_revisions(config, package)
-    massert(revs, f"There are no built revisions for package {package.name}")
-    if rev is None:
-        rev, _ = sort_revisions_n2o(revs)[0]
-        LOG.debug(
-            "No revision specified for package %s, using revision %s", package.name, rev
-        )
-    else:
-        massert(rev in revs, f"Unknown revision {rev} for package {package.name}")
-
-    artifacts = revs[rev]
-    rand_artifact, _ = list(revs[rev].items())[0]
-    rand_path = os.path.join(server.path, rand_artifact)
-    current_rev = None
-    if os.path.islink(rand_path):
-        root, ext = os.path.splitext(os.path.basename(rand_artifact))
-        match = re.match(
-            rf"{re.escape(root)}\-(?P<rev>[a-zA-Z0-9]+){re.escape(ext)}$",
-            os.path.basename(os.readlink(rand_path)),
+    upgrades: Dict[str, Dict[str, Tuple[str, int]]] = {}
+    for package in packages:
+        massert(
+            package.name in server.packages,
+            f"Package {package.name} not used by server {server.name}",
         )
-        if match:
-            current_rev = match.group("rev")
+        revs = package_revisions(config, package)
+        massert(revs, f"There are no built revisions for package {package.name}")
+        pkg_rev = rev
+        if pkg_rev is None:
+            pkg_rev, _ = sort_revisions_n2o(revs)[0]
+            LOG.debug(
+                "No revision specified for package %s, using revision %s",
+                package.name,
+                pkg_rev,
+            )
+        else:
+            massert(
+                pkg_rev in revs,
+                f"Unknown revision {pkg_rev} for package {package.name}",
+            )
 
-        if not force and current_rev == rev:
+        current_rev = get_current_revision(server, {pkg_rev: revs[pkg_rev]})
+        if not force and current_rev == pkg_rev:
             LOG.info(
                 "Package %s already up-to-date for server %s, skipping",
                 package.name,
                 server.name,
             )
-            return
+            continue
+
+        LOG.info(
+            "Upgrading package %s to revision %s from revision %s",
+            package.name,
+            pkg_rev,
+            current_rev,
+        )
+        upgrades[package.name] = revs[pkg_rev]
 
+    if not upgrades:
+        return
+
+    gens_dir = get_generations_dir(config, server)
+    os.makedirs(gens_dir, exist_ok=True)
+    current_link = os.path.join(gens_dir, "current")
+    current = os.readlink(current_link) if os.path.islink(current_link) else None
+    if current is not None:
+        artifacts = read_generation(os.path.join(gens_dir, current))
+    else:
+        # Servers upgraded before generations existed link to the archive
+        artifacts = {}
+        for package_name in server.packages:
+            for path in config.get_package(package_name).artifacts:
+                artifact_path = os.path.join(server.path, path)
+                if os.path.islink(artifact_path):
+                    artifacts[path] = os.path.realpath(artifact_path)
+
+    for package_artifacts in upgrades.values():
+        for path, (archive_path, _) in package_artifacts.items():
+            artifacts[path] = archive_path
+
+    gen_ids = [int(name) for name in os.listdir(gens_dir) if name.isdigit()]
+    new_gen = str(max(gen_ids, default=0) + 1)
+    tmp_dir = os.path.join(gens_dir, f"{new_gen}.tmp")
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    for path, archive_path in artifacts.items():
+        gen_path = os.path.join(tmp_dir, path)
+        LOG.debug("Linking archived artifact %s to %s", archive_path, gen_path)
+        os.makedirs(os.path.dirname(gen_path), exist_ok=True)
+        os.symlink(archive_path, gen_path)
+
+    os.rename(tmp_dir, os.path.join(gens_dir, new_gen))
+    switch_generation(gens_dir, new_gen, current)
+    link_generation(config, server, artifacts)
+    prune_generations(gens_dir)
     LOG.info(
-        "Upgrading package %s to revision %s from revision %s",
-        package.name,
-        rev,
-        current_rev,
+        "Switched server %s to generation %s with %d upgraded packages",
+        server.name,
+        new_gen,
+        len(upgrades),
     )
 
-    for path, info in artifacts.items():
-        archive_path, _ = info
-        artifact_path = os.path.join(server.path, path)
-        if os.path.exists(artifact_path):
-            LOG.debug("Removing old artifact %s", artifact_path)
-            os.unlink(artifact_path)
 
-        LOG.debug("Linking archived artifact %s to %s", archive_path, artifact_path)
-        os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
-        os.symlink(archive_path, artifact_path)
+def packages_rollback(config: Config, server: Server) -> None:
+    gens_dir = get_generations_dir(config, server)
+    current_link = os.path.join(gens_dir, "current")
+    previous_link = os.path.join(gens_dir, "previous")
+    massert(
+        os.path.islink(previous_link),
+        f"There is no previous generation for server {server.name}",
+    )
+    current = os.readlink(current_link)
+    previous = os.readlink(previous_link)
+    artifacts = read_generation(os.path.join(gens_dir, previous))
+    switch_generation(gens_dir, previous, current)
+    link_generation(config, server, artifacts)
+    LOG.info(
+        "Rolled back server %s from generation %s to generation %s",
+        server.name,
+        current,
+        previous,
+    )
 
 
 def sort_revisions_n2o(
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from mctl.codec import PacketWriter, ProtocolError, read_packet
+
+DEFAULT_PING_TIMEOUT = 5.0
+# Status responses carry a base64 encoded favicon, allow for a large one
+MAX_RESPONSE_LENGTH = 1 << 21
+LOG = logging.getLogger(__name__)
+
+
+class PingResult(NamedTuple):
+    online: bool
+    version: Optional[str] = None
+    protocol: Optional[int] = None
+    players_online: Optional[int] = None
+    players_max: Optional[int] = None
+    motd: Optional[str] = None
+    latency: Optional[float] = None
+    error: Optional[str] = None
+
+
+def flatten_description(description: Any) -> str:
+    if isinstance(description, str):
+        return description
+
+    if not isinstance(description, dict):
+        return ""
+
+    text = str(description.get("text", ""))
+    extras = description.get("extra")
+    for extra in extras if isinstance(extras, list) else []:
+        text += flatten_description(extra)
+
+    return text
+
+
+async def ping_status(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    host: str,
+    port: int,
+) -> Tuple[Dict[str, Any], float]:
+    # A protocol version of -1 is used by clients to probe for the version
+    handshake = PacketWriter(0)
+    handshake.write_varint(-1)
+    handshake.write_str(host)
+    handshake.write_short(port)
+    handshake.write_varint(1)
+    writer.write(handshake.finish())
+    start = time.monotonic()
+    writer.write(PacketWriter(0).finish())
+    await writer.drain()
+
+    packet_id, packet = await read_packet(reader, MAX_RESPONSE_LENGTH)
+    status_latency = (time.monotonic() - start) * 1000
+    if packet_id != 0:
+        raise ProtocolError(f"Unexpected status packet ID 0x{packet_id:02x}")
+
+    response = json.loads(packet.read_str())
+    if not isinstance(response, dict):
+        raise ProtocolError("Status response is not a JSON object")
+
+    payload = int(time.time() * 1000)
+    ping_packet = PacketWriter(1)
+    ping_packet.write_long(payload)
+    try:
+        start = time.monotonic()
+        writer.write(ping_packet.finish())
+        await writer.drain()
+        packet_id, packet = await read_packet(reader, MAX_RESPONSE_LENGTH)
+        latency = (time.monotonic() - start) * 1000
+    except (OSError, asyncio.IncompleteReadError, ProtocolError) as ex:
+        # Some servers close the connection rather than answering the ping,
+        # fall back to the latency of the status request.
+        LOG.debug("Failed to ping %s on port %d: %s", host, port, ex)
+        return response, status_latency
+
+    if packet_id != 1 or packet.read_long() != payload:
+        raise ProtocolError("Invalid pong response")
+
+    return response, latency
+
+
+async def ping_server(host: str, port: int) -> Tuple[Dict[str, Any], float]:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await ping_status(reader, writer, host, port)
+    finally:
+        writer.close()
+
+
+async def ping(
+    host: str, port: int, timeout: float = DEFAULT_PING_TIMEOUT
+) -> PingResult:
+    LOG.debug("Pinging %s on port %d", host, port)
+    # The timeout covers connecting as well, a ping never takes longer
+    try:
+        response, latency = await asyncio.wait_for(ping_server(host, port), timeout)
+    except asyncio.TimeoutError:
+        return PingResult(online=False, error=f"Timed out after {timeout}s")
+    except (OSError, asyncio.IncompleteReadError, ProtocolError, ValueError) as ex:
+        return PingResult(online=False, error=str(ex) or type(ex).__name__)
+
+    # Fields of the wrong type are treated as missing
+    version = response.get("version")
+    version = version if isinstance(version, dict) else {}
+    players = response.get("players")
+    players = players if isinstance(players, dict) else {}
+    return PingResult(
+        online=True,
+        version=version.get("name"),
+        protocol=version.get("protocol"),
+        players_online=players.get("online"),
+        players_max=players.get("max"),
+        motd=flatten_description(response.get("description")),
+        latency=latency,
+    )
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from collections import defaultdict
+import logging
+import os
+import re
+import signal
+import time
+from typing import DefaultDict, Dict, List, NamedTuple, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+POLL_INTERVAL = 0.1
+PROC_PATH = "/proc"
+
+
+class ProcessStats(NamedTuple):
+    cpu_seconds: float
+    rss_bytes: int
+    threads: int
+
+
+def get_session_pid(session_name: str, screen_output: str) -> Optional[int]:
+    match = re.search(
+        rf"^\s+(?P<pid>\d+)\.{re.escape(session_name)}\s+\([^\)]+\)",
+        screen_output,
+        re.MULTILINE,
+    )
+    return int(match.group("pid")) if match else None
+
+
+def read_proc_stat(pid: int) -> Optional[List[str]]:
+    try:
+        with open(os.path.join(PROC_PATH, str(pid), "stat")) as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+
+    # The command name is wrapped in parenthesis and may contain spaces
+    comm_end = stat.rfind(")")
+    comm = stat[stat.find("(") + 1 : comm_end]
+    return [stat[: stat.find(" ")], comm] + stat[comm_end + 2 :].split()
+
+
+def get_process_children() -> Dict[int, List[int]]:
+    children: DefaultDict[int, List[int]] = defaultdict(list)
+    try:
+        pids = [int(name) for name in os.listdir(PROC_PATH) if name.isdigit()]
+    except OSError:
+        return children
+
+    for pid in pids:
+        stat = read_proc_stat(pid)
+        if stat:
+            children[int(stat[3])].append(pid)
+
+    return children
+
+
+def get_process_tree(
+    pid: int, children: Optional[Dict[int, List[int]]] = None
+) -> List[int]:
+    if children is None:
+        children = get_process_children()
+
+    tree = []
+    pending = [pid]
+    while pending:
+        current = pending.pop(0)
+        tree.append(current)
+        pending.extend(sorted(children.get(current, [])))
+
+    return tree
+
+
+def find_server_pid(
+    session_pid: int, children: Optional[Dict[int, List[int]]] = None
+) -> Optional[int]:
+    tree = get_process_tree(session_pid, children)
+    for pid in tree:
+        stat = read_proc_stat(pid)
+        if stat and stat[1] == "java":
+            return pid
+
+    # Fallback to the command started directly by screen, which may be a
+    # wrapper script around the JVM.
+    return tree[1] if len(tree) > 1 else None
+
+
+def read_process_stats(pid: int) -> Optional[ProcessStats]:
+    stat = read_proc_stat(pid)
+    if stat is None:
+        return None
+
+    clock_ticks = os.sysconf("SC_CLK_TCK")
+    return ProcessStats(
+        cpu_seconds=(int(stat[13]) + int(stat[14])) / clock_ticks,
+        rss_bytes=int(stat[23]) * os.sysconf("SC_PAGE_SIZE"),
+        threads=int(stat[19]),
+    )
+
+
+def read_process_io(pid: int) -> Tuple[int, int]:
+    read_bytes = write_bytes = 0
+    try:
+        with open(os.path.join(PROC_PATH, str(pid), "io")) as fp:
+            for line in fp:
+                key, _, value = line.partition(":")
+                if key == "read_bytes":
+                    read_bytes = int(value)
+                elif key == "write_bytes":
+                    write_bytes = int(value)
+    except OSError:
+        # Only readable by the owner of the process
+        pass
+
+    return read_bytes, write_bytes
+
+
+def count_process_fds(pid: int) -> int:
+    try:
+        return len(os.listdir(os.path.join(PROC_PATH, str(pid), "fd")))
+    except OSError:
+        return 0
+
+
+def pid_exists(pid: int) -> bool:
+    stat = read_proc_stat(pid)
+    if stat is not None:
+        # Zombies are dead, they are only waiting to be reaped
+        return stat[2] != "Z"
+
+    if os.path.isdir(PROC_PATH):
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+async def wait_for_pid_pidfd(pid: int, timeout: float) -> bool:
+    try:
+        pidfd = os.pidfd_open(pid)  # type: ignore
+    except ProcessLookupError:
+        return True
+
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def on_exit() -> None:
+        if not exited.done():
+            exited.set_result(True)
+
+    loop.add_reader(pidfd, on_exit)
+    try:
+        return await asyncio.wait_for(exited, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+
+async def wait_for_pid_polling(pid: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while pid_exists(pid):
+        if time.monotonic() >= deadline:
+            return False
+
+        await asyncio.sleep(POLL_INTERVAL)
+
+    return True
+
+
+async def wait_for_pid(pid: int, timeout: float) -> bool:
+    if hasattr(os, "pidfd_open"):
+        try:
+            return await wait_for_pid_pidfd(pid, timeout)
+        except OSError as ex:
+            LOG.debug("Failed to wait on pidfd for %d, polling: %s", pid, ex)
+
+    return await wait_for_pid_polling(pid, timeout)
+
+
+async def terminate_pid(
+    pid: int, timeout: float, term_timeout: float, name: str
+) -> None:
+    start = time.monotonic()
+    if await wait_for_pid(pid, timeout):
+        LOG.debug(
+            "Process %d for %s exited after %.3fs", pid, name, time.monotonic() - start
+        )
+        return
+
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        LOG.warning(
+            "Process %d for %s still running after %.3fs, sending %s",
+            pid,
+            name,
+            time.monotonic() - start,
+            sig.name,
+        )
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            return
+
+        if await wait_for_pid(pid, term_timeout):
+            return
+
+    LOG.error("Process %d for %s failed to exit after SIGKILL", pid, name)
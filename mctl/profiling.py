@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+    cast,
+)
+
+# The span the current task is in. Tasks copy the context they are created
+# in, so spans opened by concurrent tasks nest under the span which started
+# them.
+CURRENT_SPAN: "ContextVar[Optional[Span]]" = ContextVar("CURRENT_SPAN", default=None)
+LOG = logging.getLogger(__name__)
+PROFILER: Optional["Profiler"] = None
+# Spans shorter than this are left out of the summary, not the trace
+SUMMARY_MIN_SECONDS = 0.001
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+class Span:
+    def __init__(self, name: str, tid: int, args: Dict[str, Any]) -> None:
+        self.name = name
+        self.tid = tid
+        self.args = args
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List["Span"] = []
+
+    def seconds(self, now: float) -> float:
+        return (self.end or now) - self.start
+
+
+class Profiler:
+    def __init__(self, name: str) -> None:
+        self.cprofile: Optional[Any] = None
+        # Every asyncio task with a span gets its own track in the trace
+        self.tasks: Dict["asyncio.Task[Any]", int] = {}
+        self.track_names: Dict[int, str] = {0: "main"}
+        self.root = Span(name, 0, {})
+
+    def get_tid(self, name: str) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        if task is None:
+            return 0
+
+        tid = self.tasks.get(task)
+        if tid is None:
+            tid = self.tasks[task] = len(self.tasks) + 1
+            self.track_names[tid] = f"Task {tid}: {name}"
+
+        return tid
+
+    @contextmanager
+    def span(self, name: str, args: Dict[str, Any]) -> Iterator[None]:
+        # Commands run their config loading and main coroutine in separate
+        # event loops, which do not share a context.
+        parent = CURRENT_SPAN.get() or self.root
+        # Keeps multiline shell commands on a single line of the summary
+        name = " ".join(name.split())
+        span = Span(name, self.get_tid(name), args)
+        parent.children.append(span)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield
+        finally:
+            span.end = time.perf_counter()
+            CURRENT_SPAN.reset(token)
+
+    def start_cprofile(self) -> None:
+        import cProfile
+
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def finish(self) -> None:
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+        if self.root.end is None:
+            self.root.end = time.perf_counter()
+
+    def summary(self) -> str:
+        now = time.perf_counter()
+        total = self.root.seconds(now)
+        lines = [f"Profile of {self.root.name} ({total:.3f}s):"]
+
+        # Sibling spans with the same name, like repeated screen listings,
+        # are summed into one line.
+        def add_lines(spans: List[Span], depth: int) -> None:
+            groups: Dict[str, List[Span]] = {}
+            for span in spans:
+                groups.setdefault(span.name, []).append(span)
+
+            for name, group in groups.items():
+                seconds = sum(span.seconds(now) for span in group)
+                if seconds < SUMMARY_MIN_SECONDS:
+                    continue
+
+                count = f" (x{len(group)})" if len(group) > 1 else ""
+                percent = seconds / total * 100 if total else 0.0
+                lines.append(
+                    f"{seconds:9.3f}s {percent:5.1f}%  {'  ' * depth}{name}{count}"
+                )
+                add_lines(
+                    [child for span in group for child in span.children], depth + 1
+                )
+
+        add_lines([self.root], 0)
+        return "\n".join(lines)
+
+    def trace_events(self) -> List[Dict[str, Any]]:
+        now = time.perf_counter()
+        pid = os.getpid()
+        events: List[Dict[str, Any]] = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in self.track_names.items()
+        ]
+        spans = [self.root]
+        while spans:
+            span = spans.pop()
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": "mctl",
+                    "ph": "X",
+                    "ts": (span.start - self.root.start) * 1e6,
+                    "dur": span.seconds(now) * 1e6,
+                    "pid": pid,
+                    "tid": span.tid,
+                    "args": span.args,
+                }
+            )
+            spans.extend(span.children)
+
+        return events
+
+    def write_trace(self, path: str) -> None:
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": self.trace_events()}, fp)
+
+        LOG.info("Wrote trace of %s to %s", self.root.name, path)
+
+    def write_stats(self, path: str) -> None:
+        if self.cprofile is None:
+            return
+
+        self.cprofile.dump_stats(path)
+        LOG.info("Wrote profile of %s to %s", self.root.name, path)
+
+
+def start_profiler(name: str, cprofile: bool = False) -> Profiler:
+    global PROFILER
+    PROFILER = Profiler(name)
+    if cprofile:
+        PROFILER.start_cprofile()
+
+    return PROFILER
+
+
+def span(name: str, **args: Any) -> ContextManager[None]:
+    # Kept as cheap as possible when not profiling, as it wraps every shell
+    # command mctl runs.
+    if PROFILER is None:
+        return nullcontext()
+
+    return PROFILER.span(name, args)
+
+
+def spanned(name: str) -> Callable[[F], F]:
+    # The name is formatted with the arguments of the call, ex:
+    # "start server {server.name}"
+    def decorator(func: F) -> F:
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if PROFILER is None:
+                return await func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            with PROFILER.span(name.format(**bound.arguments), {}):
+                return await func(*args, **kwargs)
+
+        return cast(F, wrapper)
+
+    return decorator
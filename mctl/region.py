@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import stat
+import struct
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from mctl.config import Config, Server
+from mctl.exception import massert
+from mctl.server import server_saves_paused
+
+CHUNK_COUNT = 1024
+DEFAULT_REGION_JOBS = min(8, os.cpu_count() or 1)
+HEADER_SIZE = 2 * CHUNK_COUNT * 4
+LOG = logging.getLogger(__name__)
+# The sector count of a chunk is a single byte, larger chunks are kept in
+# their own .mcc files by the server.
+MAX_CHUNK_SECTORS = 255
+SECTOR_SIZE = 4096
+TABLE = struct.Struct(f">{CHUNK_COUNT}I")
+
+# (chunk index, timestamp, hash of the chunk data)
+ChunkRef = Tuple[int, int, str]
+
+
+class RegionBackupStats(NamedTuple):
+    regions: int
+    chunks: int
+    stored_chunks: int
+    stored_bytes: int
+    seconds: float
+
+
+def get_regions_dir(config: Config, server: Server) -> str:
+    return os.path.join(config.data_path, "regions", server.name)
+
+
+def find_worlds(server: Server) -> List[str]:
+    # Every world, including the nether and end of Bukkit based servers, has
+    # a level.dat at its root.
+    return sorted(
+        name
+        for name in os.listdir(server.path)
+        if os.path.isfile(os.path.join(server.path, name, "level.dat"))
+    )
+
+
+def list_manifests(config: Config, server: Server) -> List[str]:
+    manifests_dir = os.path.join(get_regions_dir(config, server), "manifests")
+    if not os.path.isdir(manifests_dir):
+        return []
+
+    return sorted(name for name in os.listdir(manifests_dir) if name.endswith(".json"))
+
+
+def read_manifest(config: Config, server: Server, name: str) -> Dict[str, Any]:
+    path = os.path.join(get_regions_dir(config, server), "manifests", name)
+    massert(os.path.isfile(path), f"Region backup {name} does not exist")
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def store_blob(store_dir: str, data: bytes) -> Tuple[str, bool]:
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(store_dir, digest[:2], digest)
+    if os.path.exists(path):
+        return digest, False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+
+    os.replace(tmp_path, path)
+    return digest, True
+
+
+def load_blob(store_dir: str, digest: str) -> bytes:
+    with open(os.path.join(store_dir, digest[:2], digest), "rb") as fp:
+        return fp.read()
+
+
+def backup_region(
+    path: str, store_dir: str, prev: Optional[Dict[str, Any]]
+) -> Tuple[List[ChunkRef], int, int]:
+    prev_chunks = (
+        {index: (ts, digest) for index, ts, digest in prev["chunks"]} if prev else {}
+    )
+    chunks: List[ChunkRef] = []
+    stored = stored_bytes = 0
+    with open(path, "rb") as fp, mmap.mmap(
+        fp.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        locations = TABLE.unpack_from(data, 0)
+        timestamps = TABLE.unpack_from(data, TABLE.size)
+        for index, location in enumerate(locations):
+            if location == 0:
+                continue
+
+            timestamp = timestamps[index]
+            prev_chunk = prev_chunks.get(index)
+            # The server updates the timestamp whenever it writes a chunk, so
+            # an unchanged timestamp means the data is already stored.
+            if prev_chunk is not None and prev_chunk[0] == timestamp:
+                chunks.append((index, timestamp, prev_chunk[1]))
+                continue
+
+            offset = (location >> 8) * SECTOR_SIZE
+            if offset + 4 > len(data):
+                LOG.warning("Chunk %d of %s is out of bounds, skipping", index, path)
+                continue
+
+            (length,) = struct.unpack_from(">I", data, offset)
+            end = offset + 4 + length
+            if length == 0 or end > len(data):
+                LOG.warning("Chunk %d of %s is truncated, skipping", index, path)
+                continue
+
+            if end - offset > MAX_CHUNK_SECTORS * SECTOR_SIZE:
+                LOG.warning("Chunk %d of %s is too large, skipping", index, path)
+                continue
+
+            digest, new = store_blob(store_dir, data[offset:end])
+            if new:
+                stored += 1
+                stored_bytes += end - offset
+
+            chunks.append((index, timestamp, digest))
+
+    return chunks, stored, stored_bytes
+
+
+def build_region(path: str, store_dir: str, chunks: List[ChunkRef]) -> None:
+    locations = [0] * CHUNK_COUNT
+    timestamps = [0] * CHUNK_COUNT
+    sector = HEADER_SIZE // SECTOR_SIZE
+    with open(path, "wb") as fp:
+        fp.seek(HEADER_SIZE)
+        for index, timestamp, digest in chunks:
+            payload = load_blob(store_dir, digest)
+            sectors = -(-len(payload) // SECTOR_SIZE)
+            massert(
+                sectors <= MAX_CHUNK_SECTORS,
+                f"Chunk {index} of {path} needs {sectors} sectors, "
+                f"at most {MAX_CHUNK_SECTORS} fit in a region file",
+            )
+            locations[index] = (sector << 8) | sectors
+            timestamps[index] = timestamp
+            fp.write(payload.ljust(sectors * SECTOR_SIZE, b"\0"))
+            sector += sectors
+
+        fp.seek(0)
+        fp.write(TABLE.pack(*locations))
+        fp.write(TABLE.pack(*timestamps))
+
+
+def is_region(path: str, st: os.stat_result) -> bool:
+    return path.endswith(".mca") and st.st_size >= HEADER_SIZE
+
+
+def scan_worlds(server: Server, worlds: List[str]) -> Dict[str, os.stat_result]:
+    files = {}
+    for world in worlds:
+        for root, _, file_names in os.walk(os.path.join(server.path, world)):
+            for name in file_names:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    files[os.path.relpath(path, server.path)] = st
+
+    return files
+
+
+def write_region_backup(
+    server: Server, store_dir: str, prev: Dict[str, Any], jobs: int
+) -> Tuple[Dict[str, Any], RegionBackupStats]:
+    start = time.monotonic()
+    worlds = find_worlds(server)
+    massert(worlds, f"No worlds found in {server.path}")
+    files = scan_worlds(server, worlds)
+    manifest: Dict[str, Any] = {"worlds": worlds, "regions": {}, "files": {}}
+
+    def backup_file(rel_path: str) -> Tuple[str, Dict[str, Any], int, int]:
+        st = files[rel_path]
+        path = os.path.join(server.path, rel_path)
+        entry: Dict[str, Any] = {
+            "mode": stat.S_IMODE(st.st_mode),
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+        }
+        kind = "regions" if is_region(rel_path, st) else "files"
+        prev_entry = prev.get(kind, {}).get(rel_path)
+        if (
+            prev_entry is not None
+            and prev_entry["size"] == st.st_size
+            and prev_entry["mtime_ns"] == st.st_mtime_ns
+        ):
+            return kind, prev_entry, 0, 0
+
+        if kind == "regions":
+            chunks, stored, stored_bytes = backup_region(path, store_dir, prev_entry)
+            entry["chunks"] = chunks
+            return kind, entry, stored, stored_bytes
+
+        with open(path, "rb") as fp:
+            digest, new = store_blob(store_dir, fp.read())
+
+        entry["hash"] = digest
+        return kind, entry, int(new), st.st_size if new else 0
+
+    stored = stored_bytes = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for rel_path, (kind, entry, file_stored, file_bytes) in zip(
+            files, executor.map(backup_file, files)
+        ):
+            manifest[kind][rel_path] = entry
+            stored += file_stored
+            stored_bytes += file_bytes
+
+    return manifest, RegionBackupStats(
+        regions=len(manifest["regions"]),
+        chunks=sum(len(entry["chunks"]) for entry in manifest["regions"].values()),
+        stored_chunks=stored,
+        stored_bytes=stored_bytes,
+        seconds=time.monotonic() - start,
+    )
+
+
+def prune_region_backups(config: Config, server: Server) -> None:
+    regions_dir = get_regions_dir(config, server)
+    manifests = list_manifests(config, server)
+    for name in manifests[: max(len(manifests) - config.max_snapshots, 0)]:
+        LOG.info("Removing old region backup %s of server %s", name, server.name)
+        os.remove(os.path.join(regions_dir, "manifests", name))
+
+    used: Set[str] = set()
+    for name in list_manifests(config, server):
+        manifest = read_manifest(config, server, name)
+        used.update(entry["hash"] for entry in manifest["files"].values())
+        for entry in manifest["regions"].values():
+            used.update(digest for _, _, digest in entry["chunks"])
+
+    removed = 0
+    store_dir = os.path.join(regions_dir, "store")
+    for root, _, file_names in os.walk(store_dir):
+        for name in file_names:
+            if name not in used:
+                os.remove(os.path.join(root, name))
+                removed += 1
+
+    LOG.debug("Removed %d unused blobs of server %s", removed, server.name)
+
+
+async def server_region_backup(
+    config: Config, server: Server, jobs: int = DEFAULT_REGION_JOBS
+) -> str:
+    regions_dir = get_regions_dir(config, server)
+    store_dir = os.path.join(regions_dir, "store")
+    manifests = list_manifests(config, server)
+    prev = read_manifest(config, server, manifests[-1]) if manifests else {}
+    name = time.strftime("%Y%m%d-%H%M%S.json")
+    # Manifests are named by the second they were created in
+    massert(
+        name not in manifests,
+        f"Region backup {name} of server {server.name} already exists",
+    )
+    LOG.info(
+        "Creating region backup %s of server %s from previous backup %s",
+        name,
+        server.name,
+        manifests[-1] if manifests else None,
+    )
+
+    loop = asyncio.get_running_loop()
+    async with server_saves_paused(server):
+        manifest, stats = await loop.run_in_executor(
+            None, write_region_backup, server, store_dir, prev, jobs
+        )
+
+    manifests_dir = os.path.join(regions_dir, "manifests")
+    os.makedirs(manifests_dir, exist_ok=True)
+    tmp_path = os.path.join(manifests_dir, f"{name}.tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(manifest, fp)
+
+    os.replace(tmp_path, os.path.join(manifests_dir, name))
+    LOG.info(
+        "Created region backup %s of server %s in %.3fs: %d regions, %d chunks, "
+        "%d new blobs stored (%d bytes)",
+        name,
+        server.name,
+        stats.seconds,
+        stats.regions,
+        stats.chunks,
+        stats.stored_chunks,
+        stats.stored_bytes,
+    )
+    prune_region_backups(config, server)
+    return name
+
+
+def restore_region_backup(
+    manifest: Dict[str, Any], store_dir: str, dest_dir: str, jobs: int
+) -> None:
+    def restore_file(item: Tuple[str, Dict[str, Any]]) -> None:
+        rel_path, entry = item
+        path = os.path.join(dest_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if "chunks" in entry:
+            build_region(path, store_dir, entry["chunks"])
+        else:
+            shutil.copyfile(
+                os.path.join(store_dir, entry["hash"][:2], entry["hash"]), path
+            )
+
+        os.chmod(path, entry["mode"])
+        os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    items = list(manifest["files"].items()) + list(manifest["regions"].items())
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(restore_file, items):
+            pass
+
+
+async def server_region_restore(
+    config: Config,
+    server: Server,
+    name: Optional[str],
+    dest_dir: str,
+    jobs: int = DEFAULT_REGION_JOBS,
+) -> None:
+    massert(
+        not os.path.exists(dest_dir) or not os.listdir(dest_dir),
+        f"Restore path {dest_dir} is not empty",
+    )
+    if name is None:
+        manifests = list_manifests(config, server)
+        massert(manifests, f"No region backups of server {server.name}")
+        name = manifests[-1]
+
+    manifest = read_manifest(config, server, name)
+    store_dir = os.path.join(get_regions_dir(config, server), "store")
+    LOG.info(
+        "Restoring region backup %s of server %s to %s", name, server.name, dest_dir
+    )
+    start = time.monotonic()
+    await asyncio.get_running_loop().run_in_executor(
+        None, restore_region_backup, manifest, store_dir, dest_dir, jobs
+    )
+    LOG.info(
+        "Restored region backup %s of server %s in %.3fs: %s",
+        name,
+        server.name,
+        time.monotonic() - start,
+        ", ".join(manifest["worlds"]),
+    )
@@ -22,6 +22,7 @@ from typing import List, Iterable, Optional, Type
 
 from mctl.config import Repository
 from mctl.exception import massert, MctlError
+from mctl.profiling import spanned
 from mctl.util import execute_shell_check
 
 LOG = logging.getLogger(__name__)
@@ -99,6 +100,7 @@ class GitRepository(ScmRepository):
         return rev
 
     @staticmethod
+    @spanned("update git repository {repo_dir}")
     async def update(
         repo_dir: str, url: Optional[str] = None, committish: Optional[str] = None
     ) -> None:
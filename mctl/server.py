@@ -12,19 +12,46 @@
 # The above copyright notice and this permission notice shall be included in
 # all copies or substantial portions of the Software.
 
-import aiofiles
 import asyncio
+from contextlib import asynccontextmanager
 import logging
 import os
 import re
-import sys
-from typing import Dict, NamedTuple, Optional
+import signal
+import statistics
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from mctl.config import Server
-from mctl.exception import massert
+from mctl.exception import massert, MctlError
+from mctl.fake_host import ensure_fake_host, fake_host_request, get_fake_host_servers
+from mctl.fake_server import DEFAULT_PORT, FAKE_VERSION_NAME
+from mctl.logs import (
+    get_log_path,
+    get_startup_history,
+    LogEventType,
+    LogTailer,
+    wait_for_log_event,
+)
+from mctl.ping import DEFAULT_PING_TIMEOUT, ping, PingResult
+from mctl.process import find_server_pid, get_session_pid, terminate_pid
+from mctl.profiling import span, spanned
 from mctl.util import execute_shell_check
 
 LOG = logging.getLogger(__name__)
+SAVE_TIMEOUT = 60
+SESSION_EXIT_TIMEOUT = 10
+TERM_TIMEOUT = 30
 
 
 class ActiveSessions(NamedTuple):
@@ -33,6 +60,17 @@ class ActiveSessions(NamedTuple):
     fake: bool
 
 
+class SessionPids(NamedTuple):
+    session: Optional[int]
+    server: Optional[int]
+
+
+class ServerStatus(NamedTuple):
+    name: str
+    fake: bool
+    ping: PingResult
+
+
 def get_session_name(server: Server, fake: bool = False) -> str:
     name = f"mctl-{server.name}"
     if fake:
@@ -47,20 +85,63 @@ def get_session_regex(server: Server, fake: bool = False) -> re.Pattern:
     return regex
 
 
-async def get_active_sessions(server: Server) -> ActiveSessions:
-    stdout = await execute_shell_check("screen -ls", False)
-
+def parse_active_sessions(
+    server: Server, screen_output: str, fake_servers: Collection[str] = ()
+) -> ActiveSessions:
     # Main session
-    match = get_session_regex(server).search(stdout)
+    match = get_session_regex(server).search(screen_output)
     main = bool(match)
 
-    # Fake session
-    fake_match = get_session_regex(server, True).search(stdout)
-    fake = bool(fake_match)
+    # Fake server in the fake server host, or in its own session as started
+    # by older versions of mctl.
+    fake_match = get_session_regex(server, True).search(screen_output)
+    fake = server.name in fake_servers or bool(fake_match)
 
     return ActiveSessions(either=main or fake, main=main, fake=fake)
 
 
+def parse_session_pids(
+    server: Server,
+    screen_output: str,
+    fake: bool = False,
+    children: Optional[Dict[int, List[int]]] = None,
+) -> SessionPids:
+    session_name = get_session_name(server, fake)
+    session_pid = get_session_pid(session_name, screen_output)
+    if session_pid is None:
+        return SessionPids(session=None, server=None)
+
+    server_pid = find_server_pid(session_pid, children)
+    LOG.debug(
+        "Found screen session %s with pid %s and server pid %s",
+        session_name,
+        session_pid,
+        server_pid,
+    )
+    return SessionPids(session=session_pid, server=server_pid)
+
+
+async def get_screen_output() -> str:
+    return await execute_shell_check("screen -ls", False)
+
+
+async def get_active_sessions(server: Server) -> ActiveSessions:
+    stdout = await get_screen_output()
+    fake_servers = await get_fake_host_servers()
+    return parse_active_sessions(server, stdout, fake_servers)
+
+
+async def get_all_active_sessions(
+    servers: Iterable[Server],
+) -> Dict[str, ActiveSessions]:
+    stdout = await get_screen_output()
+    fake_servers = await get_fake_host_servers()
+    return {
+        server.name: parse_active_sessions(server, stdout, fake_servers)
+        for server in servers
+    }
+
+
 async def server_execute(server: Server, command: str) -> None:
     active_sessions = await get_active_sessions(server)
     massert(active_sessions.main, f"Server {server.name} not running")
@@ -75,6 +156,9 @@ async def server_properties(server: Server) -> Dict[str, str]:
         f"server.properties for server {server.name} not readable",
     )
 
+    # Imported here to keep it out of the startup of every command
+    import aiofiles
+
     props: Dict[str, str] = {}
     async with aiofiles.open(props_file) as fp:
         # For whatever reason, "async for line in fp" does not work with
@@ -92,87 +176,260 @@ async def server_properties(server: Server) -> Dict[str, str]:
     return props
 
 
-async def server_start(server: Server) -> None:
-    active_sessions = await get_active_sessions(server)
+async def server_address(server: Server) -> Tuple[str, int]:
+    props = await server_properties(server)
+    host = props.get("server-ip") or "localhost"
+    port = props.get("server-port")
+    return host, int(port) if port else DEFAULT_PORT
+
+
+async def server_status(
+    server: Server,
+    active_sessions: ActiveSessions,
+    timeout: float = DEFAULT_PING_TIMEOUT,
+) -> ServerStatus:
+    try:
+        host, port = await server_address(server)
+    except (MctlError, ValueError) as ex:
+        result = PingResult(online=False, error=str(ex))
+    else:
+        result = await ping(host, port, timeout)
+
+    # The fake server always identifies itself as MCTL, which also catches a
+    # fake server not started by mctl.
+    fake = active_sessions.fake or result.version == FAKE_VERSION_NAME
+    return ServerStatus(name=server.name, fake=fake, ping=result)
+
+
+@spanned("start server {server.name}")
+async def server_start(server: Server, wait: bool = False) -> Optional[float]:
+    stdout = await get_screen_output()
+    fake_servers = await get_fake_host_servers()
+    active_sessions = parse_active_sessions(server, stdout, fake_servers)
     massert(not active_sessions.main, f"Server {server.name} already running")
-    if active_sessions.fake:
+    # The JVM does not bind with SO_REUSEPORT, so the fake server must be gone
+    # before the server is launched. A hosted fake server closes its listener
+    # before the host responds, without looking up any sessions again.
+    if server.name in fake_servers:
+        LOG.info("Stopping fake server %s", server.name)
+        await fake_host_request({"action": "remove", "name": server.name})
+    elif active_sessions.fake:
         await server_stop_fake(server)
 
     session_name = get_session_name(server)
     LOG.info("Starting server %s with screen session %s", server.name, session_name)
-    await execute_shell_check(
-        f"screen -S '{session_name}' -dm {server.command}", cwd=server.path
-    )
+    # Start tailing before the server starts to avoid missing any lines
+    with LogTailer(get_log_path(server)) as tailer:
+        start = time.monotonic()
+        await execute_shell_check(
+            f"screen -S '{session_name}' -dm {server.command}", cwd=server.path
+        )
+        if not wait:
+            return None
+
+        LOG.info("Waiting for server %s to finish starting", server.name)
+        with span("wait for ready"):
+            event = await wait_for_log_event(
+                tailer, [LogEventType.READY, LogEventType.CRASHED], server.start_timeout
+            )
+
+    if event.type == LogEventType.CRASHED:
+        raise MctlError(f"Server {server.name} failed to start: {event.line}")
 
-
-async def server_start_fake(server: Server, message: Optional[str] = None) -> None:
-    active_sessions = await get_active_sessions(server)
-    massert(not active_sessions.either, f"Server {server.name} already running")
-    session_name = get_session_name(server, True)
     LOG.info(
-        "Starting fake server %s with screen session %s", server.name, session_name
+        "Server %s ready after %.3fs (server reported %.3fs)",
+        server.name,
+        time.monotonic() - start,
+        event.seconds,
     )
+    return event.seconds
 
-    props = await server_properties(server)
-    cmdargs = [sys.argv[0], "fake-server"]
-    server_ip = props.get("server-ip")
-    if server_ip:
-        cmdargs.append(f"--listen-address='{server_ip}'")
 
+async def get_fake_request(server: Server, message: Optional[str]) -> Dict[str, Any]:
+    props = await server_properties(server)
+    request: Dict[str, Any] = {
+        "name": server.name,
+        "listen_address": props.get("server-ip") or None,
+        "message": message,
+    }
     icon_file = os.path.join(server.path, "server-icon.png")
     if os.path.exists(icon_file):
-        cmdargs.append(f"--icon-file='{icon_file}'")
-
-    if message:
-        cmdargs.append(f"--message='{message}'")
+        request["icon_file"] = icon_file
 
     motd = props.get("motd")
     if motd:
-        cmdargs.append(f"--motd='[Server Offline] {motd}'")
+        request["motd"] = f"[Server Offline] {motd}"
 
     server_port = props.get("server-port")
     if server_port:
-        cmdargs.append(f"--port='{server_port}'")
+        request["port"] = int(server_port)
+
+    if server.wake_on_join:
+        history = await asyncio.get_running_loop().run_in_executor(
+            None, get_startup_history, server
+        )
+        request["wake_on_join"] = True
+        request["startup_seconds"] = statistics.median(history) if history else None
+
+    return request
+
 
-    command = " ".join(cmdargs)
-    await execute_shell_check(f"screen -S '{session_name}' -dm {command}")
+@spanned("start fake server {server.name}")
+async def server_start_fake(
+    server: Server, message: Optional[str] = None, bind_timeout: float = 0
+) -> None:
+    active_sessions = await get_active_sessions(server)
+    # A fake server in the host is updated in place, keeping its listener
+    hosted = server.name in await get_fake_host_servers()
+    massert(
+        not active_sessions.fake or hosted,
+        f"Fake server {server.name} already running",
+    )
+    # The fake server is only started alongside the server when it is about
+    # to take over the port from the stopping server.
+    massert(
+        not active_sessions.main or bind_timeout > 0,
+        f"Server {server.name} already running",
+    )
+    request = await get_fake_request(server, message)
+    request["action"] = "update" if hosted else "add"
+    request["bind_timeout"] = bind_timeout
+    if hosted:
+        LOG.info("Updating fake server %s", server.name)
+    else:
+        LOG.info("Starting fake server %s", server.name)
+        await ensure_fake_host(server.config_file)
 
+    await fake_host_request(request)
 
+
+@spanned("stop server {server.name}")
 async def server_stop(
-    server: Server, message: Optional[str], wait_for_stop_timeout: bool = True
+    server: Server,
+    message: Optional[str],
+    wait_for_stop_timeout: bool = True,
+    start_fake: bool = False,
 ) -> None:
     active_sessions = await get_active_sessions(server)
     if active_sessions.fake:
-        await server_stop_fake(server)
+        # A fake server in the host is updated in place rather than restarted
+        if not start_fake or server.name not in await get_fake_host_servers():
+            await server_stop_fake(server)
+
+        if start_fake:
+            await server_start_fake(server, message)
+
         return
 
+    start = time.monotonic()
     if wait_for_stop_timeout:
         seconds_left = server.stop_timeout
-        while seconds_left > 0:
-            say_msg = f"say Server stopping in {seconds_left} seconds"
-            if message:
-                say_msg += f": {message}"
+        with span("countdown"):
+            while seconds_left > 0:
+                say_msg = f"say Server stopping in {seconds_left} seconds"
+                if message:
+                    say_msg += f": {message}"
 
-            LOG.info("Server %s stopping in %d seconds", server.name, seconds_left)
-            await server_execute(server, say_msg)
-            wait_seconds = 5 if seconds_left >= 10 else 1
-            seconds_left -= wait_seconds
-            await asyncio.sleep(wait_seconds)
+                LOG.info("Server %s stopping in %d seconds", server.name, seconds_left)
+                await server_execute(server, say_msg)
+                wait_seconds = 5 if seconds_left >= 10 else 1
+                seconds_left -= wait_seconds
+                await asyncio.sleep(wait_seconds)
+
+        start = log_stop_phase(server, "countdown", start)
 
     LOG.info("Stopping server %s", server.name)
     await server_execute(server, "say Server stopping.")
-    await server_execute(server, "save-all")
+    with span("save"), LogTailer(get_log_path(server)) as tailer:
+        await server_execute(server, "save-all")
+        try:
+            await wait_for_log_event(tailer, [LogEventType.SAVED], SAVE_TIMEOUT)
+            LOG.info("Server %s saved", server.name)
+        except MctlError as ex:
+            LOG.warning("Failed to confirm server %s saved: %s", server.name, ex)
+
+    start = log_stop_phase(server, "save", start)
+    pids = await get_session_pids(server)
     await server_execute(server, "stop")
+    if start_fake:
+        # Start the fake server now so it is ready to bind the port as soon
+        # as the server releases it.
+        bind_timeout = server.kill_timeout + 2 * TERM_TIMEOUT + SESSION_EXIT_TIMEOUT
+        await server_start_fake(server, message, bind_timeout)
 
     LOG.info("Waiting for server %s to stop", server.name)
-    session_name = get_session_name(server)
-    await execute_shell_check(f"screen -S '{session_name}' -x", throw_on_error=False)
+    with span("shutdown"):
+        await wait_for_session_exit(server, pids, server.kill_timeout)
+    log_stop_phase(server, "shutdown", start)
 
 
+@spanned("stop fake server {server.name}")
 async def server_stop_fake(server: Server):
     active_sessions = await get_active_sessions(server)
     massert(active_sessions.fake, f"Fake server {server.name} not running")
     LOG.info("Stopping fake server %s", server.name)
+    start = time.monotonic()
     session_name = get_session_name(server, True)
-    await execute_shell_check(f"screen -S '{session_name}' -X quit")
-    await execute_shell_check(f"screen -S '{session_name}' -x", throw_on_error=False)
+    pids = await get_session_pids(server, True)
+    if pids.session is None:
+        await fake_host_request({"action": "remove", "name": server.name})
+        log_stop_phase(server, "fake shutdown", start)
+        return
+
+    if pids.server is not None:
+        # Let the fake server close its listener cleanly
+        os.kill(pids.server, signal.SIGTERM)
+    else:
+        await execute_shell_check(f"screen -S '{session_name}' -X quit")
+
+    await wait_for_session_exit(server, pids, SESSION_EXIT_TIMEOUT, True)
+    log_stop_phase(server, "fake shutdown", start)
+
+
+@asynccontextmanager
+async def server_saves_paused(server: Server) -> AsyncIterator[None]:
+    active_sessions = await get_active_sessions(server)
+    if not active_sessions.main:
+        LOG.debug("Server %s not running, no need to pause saving", server.name)
+        yield
+        return
+
+    LOG.info("Pausing saving for server %s", server.name)
+    await server_execute(server, "save-off")
+    try:
+        with LogTailer(get_log_path(server)) as tailer:
+            await server_execute(server, "save-all flush")
+            await wait_for_log_event(tailer, [LogEventType.SAVED], SAVE_TIMEOUT)
+
+        yield
+    finally:
+        LOG.info("Resuming saving for server %s", server.name)
+        await server_execute(server, "save-on")
+
+
+def log_stop_phase(server: Server, phase: str, start: float) -> float:
+    now = time.monotonic()
+    LOG.info("Server %s %s phase took %.3fs", server.name, phase, now - start)
+    return now
+
+
+async def get_session_pids(server: Server, fake: bool = False) -> SessionPids:
+    stdout = await get_screen_output()
+    return parse_session_pids(server, stdout, fake)
+
+
+async def wait_for_session_exit(
+    server: Server, pids: SessionPids, timeout: float, fake: bool = False
+) -> None:
+    session_name = get_session_name(server, fake)
+    if pids.session is None:
+        LOG.debug("Screen session %s already exited", session_name)
+        return
+
+    # Wait on the server process itself when it can be found, the screen
+    # session exits on its own once the process it was started with exits.
+    if pids.server is not None:
+        await terminate_pid(pids.server, timeout, TERM_TIMEOUT, session_name)
+        timeout = SESSION_EXIT_TIMEOUT
+
+    await terminate_pid(pids.session, timeout, TERM_TIMEOUT, session_name)
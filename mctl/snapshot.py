@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import shutil
+import stat
+import time
+from typing import List, NamedTuple, Optional
+
+from mctl.config import Config, Server
+from mctl.exception import massert, MctlError
+from mctl.server import server_saves_paused
+
+DEFAULT_SNAPSHOT_JOBS = min(8, os.cpu_count() or 1)
+LOG = logging.getLogger(__name__)
+
+
+class SnapshotStats(NamedTuple):
+    linked: int
+    copied: int
+    copied_bytes: int
+
+
+def get_snapshots_dir(config: Config, server: Server) -> str:
+    return os.path.join(config.data_path, "snapshots", server.name)
+
+
+def list_snapshots(config: Config, server: Server) -> List[str]:
+    snapshots_dir = get_snapshots_dir(config, server)
+    if not os.path.isdir(snapshots_dir):
+        return []
+
+    # Snapshots are named by their creation time, so they sort oldest first
+    return sorted(
+        name
+        for name in os.listdir(snapshots_dir)
+        if not name.endswith(".tmp")
+        and os.path.isdir(os.path.join(snapshots_dir, name))
+    )
+
+
+def is_unchanged(src: os.stat_result, prev_path: str) -> bool:
+    try:
+        prev = os.lstat(prev_path)
+    except FileNotFoundError:
+        return False
+
+    return prev.st_size == src.st_size and prev.st_mtime_ns == src.st_mtime_ns
+
+
+def create_snapshot(
+    src_dir: str, dest_dir: str, prev_dir: Optional[str], skip_dir: str, jobs: int
+) -> SnapshotStats:
+    linked = copied = copied_bytes = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for root, dir_names, file_names in os.walk(src_dir):
+            rel_root = os.path.relpath(root, src_dir)
+            os.makedirs(os.path.join(dest_dir, rel_root), exist_ok=True)
+            for name in list(dir_names):
+                path = os.path.join(root, name)
+                # Avoid snapshotting the snapshots when the data path is
+                # inside of the server directory.
+                if os.path.realpath(path) == skip_dir:
+                    dir_names.remove(name)
+                elif os.path.islink(path):
+                    dir_names.remove(name)
+                    file_names.append(name)
+
+            for name in file_names:
+                src_path = os.path.join(root, name)
+                dest_path = os.path.join(dest_dir, rel_root, name)
+                st = os.lstat(src_path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src_path), dest_path)
+                    continue
+
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+
+                if prev_dir is not None:
+                    prev_path = os.path.join(prev_dir, rel_root, name)
+                    if is_unchanged(st, prev_path):
+                        os.link(prev_path, dest_path)
+                        linked += 1
+                        continue
+
+                futures.append(executor.submit(shutil.copy2, src_path, dest_path))
+                copied += 1
+                copied_bytes += st.st_size
+
+        for future in futures:
+            future.result()
+
+    return SnapshotStats(linked=linked, copied=copied, copied_bytes=copied_bytes)
+
+
+def prune_snapshots(config: Config, server: Server) -> None:
+    snapshots = list_snapshots(config, server)
+    snapshots_dir = get_snapshots_dir(config, server)
+    for name in snapshots[: max(len(snapshots) - config.max_snapshots, 0)]:
+        LOG.info("Removing old snapshot %s of server %s", name, server.name)
+        shutil.rmtree(os.path.join(snapshots_dir, name))
+
+
+async def server_snapshot(
+    config: Config, server: Server, jobs: int = DEFAULT_SNAPSHOT_JOBS
+) -> str:
+    snapshots_dir = get_snapshots_dir(config, server)
+    snapshots = list_snapshots(config, server)
+    prev_dir = os.path.join(snapshots_dir, snapshots[-1]) if snapshots else None
+    name = time.strftime("%Y%m%d-%H%M%S")
+    snapshot_dir = os.path.join(snapshots_dir, name)
+    tmp_dir = f"{snapshot_dir}.tmp"
+    # Names only go down to the second, a snapshot taken in the same second
+    # must not replace another one or the one being taken.
+    massert(
+        not os.path.exists(snapshot_dir),
+        f"Snapshot {name} of server {server.name} already exists",
+    )
+    try:
+        os.makedirs(tmp_dir)
+    except FileExistsError:
+        raise MctlError(f"Snapshot {name} of server {server.name} already running")
+
+    LOG.info(
+        "Creating snapshot %s of server %s from previous snapshot %s",
+        name,
+        server.name,
+        os.path.basename(prev_dir) if prev_dir else None,
+    )
+
+    loop = asyncio.get_running_loop()
+    try:
+        async with server_saves_paused(server):
+            start = time.monotonic()
+            stats = await loop.run_in_executor(
+                None,
+                create_snapshot,
+                server.path,
+                tmp_dir,
+                prev_dir,
+                os.path.realpath(config.data_path),
+                jobs,
+            )
+
+        os.rename(tmp_dir, snapshot_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    LOG.info(
+        "Created snapshot %s of server %s in %.3fs: %d files linked, "
+        "%d files copied (%d bytes)",
+        name,
+        server.name,
+        time.monotonic() - start,
+        stats.linked,
+        stats.copied,
+        stats.copied_bytes,
+    )
+    prune_snapshots(config, server)
+    return name
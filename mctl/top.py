@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import click
+import logging
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from mctl.config import Config
+from mctl.process import (
+    count_process_fds,
+    get_process_children,
+    get_process_tree,
+    read_process_io,
+    read_process_stats,
+)
+from mctl.server import get_screen_output, parse_session_pids
+
+DEFAULT_TOP_INTERVAL = 1.0
+LOG = logging.getLogger(__name__)
+# Number of samples before the screen sessions and process trees are looked
+# up again, unless a tracked process exits before then.
+REFRESH_SAMPLES = 10
+SORT_KEYS = ["name", "cpu", "rss", "threads", "read", "write", "fds"]
+
+
+class ServerSample(NamedTuple):
+    name: str
+    pid: int
+    time: float
+    cpu_seconds: float
+    rss_bytes: int
+    threads: int
+    read_bytes: int
+    write_bytes: int
+    fds: int
+
+
+class ServerRates(NamedTuple):
+    name: str
+    pid: int
+    cpu: float
+    rss: int
+    threads: int
+    read: float
+    write: float
+    fds: int
+
+
+def format_bytes(value: float) -> str:
+    for unit in ["B", "K", "M", "G"]:
+        if abs(value) < 1024:
+            return f"{value:.1f}{unit}"
+
+        value /= 1024
+
+    return f"{value:.1f}T"
+
+
+def sample_server(name: str, pids: List[int]) -> Optional[ServerSample]:
+    cpu_seconds = 0.0
+    rss_bytes = threads = read_bytes = write_bytes = fds = 0
+    now = time.monotonic()
+    for pid in pids:
+        stats = read_process_stats(pid)
+        if stats is None:
+            # The main process exiting means the tree needs to be refreshed
+            if pid == pids[0]:
+                return None
+
+            continue
+
+        cpu_seconds += stats.cpu_seconds
+        rss_bytes += stats.rss_bytes
+        threads += stats.threads
+        pid_read, pid_write = read_process_io(pid)
+        read_bytes += pid_read
+        write_bytes += pid_write
+        fds += count_process_fds(pid)
+
+    return ServerSample(
+        name=name,
+        pid=pids[0],
+        time=now,
+        cpu_seconds=cpu_seconds,
+        rss_bytes=rss_bytes,
+        threads=threads,
+        read_bytes=read_bytes,
+        write_bytes=write_bytes,
+        fds=fds,
+    )
+
+
+def get_rates(prev: ServerSample, cur: ServerSample) -> ServerRates:
+    elapsed = max(cur.time - prev.time, 1e-6)
+    return ServerRates(
+        name=cur.name,
+        pid=cur.pid,
+        # Totals of the process tree drop when a child exits between samples
+        cpu=100 * max(cur.cpu_seconds - prev.cpu_seconds, 0) / elapsed,
+        rss=cur.rss_bytes,
+        threads=cur.threads,
+        read=max(cur.read_bytes - prev.read_bytes, 0) / elapsed,
+        write=max(cur.write_bytes - prev.write_bytes, 0) / elapsed,
+        fds=cur.fds,
+    )
+
+
+async def get_server_trees(config: Config) -> Dict[str, List[int]]:
+    screen_output = await get_screen_output()
+    children = get_process_children()
+    trees = {}
+    for server in config.servers.values():
+        pids = parse_session_pids(server, screen_output, children=children)
+        if pids.server is not None:
+            trees[server.name] = get_process_tree(pids.server, children)
+
+    return trees
+
+
+def render_top(rates: List[ServerRates], interval: float) -> str:
+    lines = [
+        f"mctl top - {time.strftime('%H:%M:%S')}, {len(rates)} servers running, "
+        f"refreshing every {interval}s",
+        "",
+        f"{'SERVER':<20} {'PID':>7} {'CPU%':>7} {'RSS':>9} {'THR':>5} "
+        f"{'READ/s':>9} {'WRITE/s':>9} {'FDS':>6}",
+    ]
+    for rate in rates:
+        lines.append(
+            f"{rate.name[:20]:<20} {rate.pid:>7} {rate.cpu:>7.1f} "
+            f"{format_bytes(rate.rss):>9} {rate.threads:>5} "
+            f"{format_bytes(rate.read):>9} {format_bytes(rate.write):>9} "
+            f"{rate.fds:>6}"
+        )
+
+    return "\n".join(lines)
+
+
+async def run_top(
+    config: Config,
+    interval: float = DEFAULT_TOP_INTERVAL,
+    sort_key: str = "cpu",
+    iterations: int = 0,
+) -> None:
+    trees: Dict[str, List[int]] = {}
+    prev_samples: Dict[str, ServerSample] = {}
+    refresh_in = 0
+    iteration = 0
+    # The first sample only serves as the baseline for the rates
+    while iterations <= 0 or iteration <= iterations:
+        if refresh_in <= 0:
+            trees = await get_server_trees(config)
+            refresh_in = REFRESH_SAMPLES
+
+        refresh_in -= 1
+        samples = {}
+        for name, pids in trees.items():
+            sample = sample_server(name, pids)
+            if sample is None:
+                refresh_in = 0
+            else:
+                samples[name] = sample
+
+        rates = [
+            get_rates(prev_samples[name], sample)
+            for name, sample in samples.items()
+            if name in prev_samples and prev_samples[name].pid == sample.pid
+        ]
+        prev_samples = samples
+        if iteration > 0:
+            rates.sort(
+                key=lambda rate: getattr(rate, sort_key), reverse=sort_key != "name"
+            )
+            click.clear()
+            click.echo(render_top(rates, interval))
+
+        iteration += 1
+        if iterations <= 0 or iteration <= iterations:
+            await asyncio.sleep(interval)
@@ -12,15 +12,14 @@
 # The above copyright notice and this permission notice shall be included in
 # all copies or substantial portions of the Software.
 
-import aiofiles
-import aiohttp
 import asyncio
 import functools
 import logging
 import os
-from typing import Any, Callable, Optional
+from typing import Any, Awaitable, Callable, Optional
 
 from mctl.exception import massert
+from mctl.profiling import spanned
 
 LOG = logging.getLogger(__name__)
 
@@ -33,7 +32,26 @@ def await_sync(func: Callable) -> Callable:
     return wrapper
 
 
+def run_event_loop(main: Awaitable[Any]) -> Any:
+    # Only worth it for the fake server which can serve a lot of clients
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        LOG.debug("uvloop not installed, using the default event loop")
+    else:
+        LOG.debug("Using the uvloop event loop")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    return asyncio.run(main)  # type: ignore
+
+
+@spanned("download {url}")
 async def download_url(url: str, dest_path: str) -> None:
+    # Imported here as aiohttp alone takes longer to import than the rest of
+    # mctl, and only builds need it.
+    import aiofiles
+    import aiohttp
+
     LOG.info("Downloading %s to %s", url, dest_path)
     os.makedirs(os.path.dirname(dest_path), exist_ok=True)
     async with aiohttp.ClientSession() as session:
@@ -49,6 +67,7 @@ async def download_url(url: str, dest_path: str) -> None:
     LOG.info("Downloaded %s to %s", url, dest_path)
 
 
+@spanned("shell {command}")
 async def execute_shell_check(
     command: str,
     throw_on_error: bool = True,
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2020 James Geboski <jgeboski@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+import asyncio
+import copy
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+import yaml
+
+from mctl.commands import cli
+from mctl.config import load_config
+from mctl.fake_host import ensure_fake_host
+
+CONFIG = {
+    "servers": {
+        "custom": {
+            "path": "",
+            "command": "java -jar server.jar",
+            "wake-on-join": True,
+            "packages": ["custom"],
+        },
+    },
+    "packages": {
+        "custom": {
+            "repositories": {
+                "custom": {
+                    "url": "https://example.com/custom.git",
+                    "type": "git",
+                    "committish": "master",
+                }
+            },
+            "build-commands": ["true"],
+            "artifacts": {"server.jar": "server\\.jar"},
+        },
+    },
+}
+
+
+class FakeHostConfigTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {"XDG_CACHE_HOME": os.path.join(tmp_dir.name, "cache")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        server_dir = os.path.join(tmp_dir.name, "server")
+        os.makedirs(server_dir)
+        with open(os.path.join(server_dir, "server.properties"), "w") as fp:
+            fp.write("motd=Custom\nserver-port=25570\n")
+
+        config = copy.deepcopy(CONFIG)
+        config["data-path"] = os.path.join(tmp_dir.name, "data")
+        config["servers"]["custom"]["path"] = server_dir
+        # Relative to check the host gets a path usable from any directory
+        self.config_file = os.path.relpath(os.path.join(tmp_dir.name, "config.yml"))
+        with open(self.config_file, "w") as fp:
+            yaml.safe_dump(config, fp)
+
+    def test_servers_know_their_config_file(self) -> None:
+        config = asyncio.run(load_config(self.config_file))
+        server = config.get_server("custom")
+        self.assertEqual(server.config_file, os.path.abspath(self.config_file))
+
+    def test_ensure_fake_host_passes_config_file(self) -> None:
+        config = asyncio.run(load_config(self.config_file))
+        server = config.get_server("custom")
+        lock_fd = os.open(os.devnull, os.O_RDONLY)
+        with mock.patch(
+            "mctl.fake_host.is_fake_host_running",
+            mock.AsyncMock(side_effect=[False, False, True]),
+        ), mock.patch(
+            "mctl.fake_host.lock_host_start", return_value=lock_fd
+        ), mock.patch(
+            "mctl.fake_host.execute_shell_check", mock.AsyncMock()
+        ) as execute:
+            asyncio.run(ensure_fake_host(server.config_file))
+
+        command = execute.call_args[0][0]
+        self.assertIn(f"-c '{server.config_file}' fake-server-host", command)
+
+    def test_host_resolves_servers_from_config_file(self) -> None:
+        with mock.patch("mctl.fake_host.FakeHost") as fake_host:
+            fake_host.return_value.run = mock.AsyncMock()
+            result = CliRunner().invoke(
+                cli, ["-c", self.config_file, "fake-server-host"]
+            )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        _, _, reload = fake_host.call_args[0]
+        request = asyncio.run(reload("custom", "Offline"))
+        self.assertEqual(request["name"], "custom")
+        self.assertEqual(request["motd"], "[Server Offline] Custom")
+        self.assertEqual(request["port"], 25570)
+        self.assertTrue(request["wake_on_join"])
+
+
+if __name__ == "__main__":
+    unittest.main()